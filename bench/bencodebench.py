@@ -0,0 +1,229 @@
+"""
+Bencode codec conformance checks and benchmarks, runs on CPython
+
+    python bench/bencodebench.py [--quick]
+
+The conformance checks round trip random values, including the
+extension types (f floats, j booleans), through every encoder and
+decoder. The benchmarks report bytes/s, packets/s and the heap cost per
+packet for representative reactor payloads.
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from config import nodekey
+from lib.bencode import (BencodeFailure, BencodeWriter, StreamDecoder, bdecode,
+                         bdecodeview, bencode, encode_into, encodeTransformer)
+from lib.product import Product
+from lib.reactor import addmodel, store
+
+
+########################################
+# Conformance
+########################################
+
+def randomvalue(rnd, depth=0):
+    """a random bencodable value, lists and dicts up to 3 levels deep"""
+    kind = rnd.randrange(7 if depth < 3 else 4)
+    if kind == 0:
+        return rnd.randint(-2**40, 2**40)
+    if kind == 1:
+        return rnd.uniform(-1e6, 1e6)
+    if kind == 2:
+        return rnd.random() < 0.5
+    if kind == 3:
+        return ''.join(rnd.choice('abcxyz019/ é€') for _ in range(rnd.randrange(12)))
+    if kind == 4:
+        return [randomvalue(rnd, depth + 1) for _ in range(rnd.randrange(5))]
+    if kind == 5:
+        return tuple(randomvalue(rnd, depth + 1) for _ in range(rnd.randrange(5)))
+    return {'k{}'.format(i): randomvalue(rnd, depth + 1) for i in range(rnd.randrange(5))}
+
+
+def normalize(x):
+    """the value bdecode returns for x, tuples decode as lists"""
+    if type(x) in (list, tuple):
+        return [normalize(i) for i in x]
+    if type(x) == dict:
+        return {k: normalize(v) for k, v in x.items()}
+    return x
+
+
+def sametype(a, b):
+    """equality that distinguishes True from 1 and 1.0 from 1"""
+    if type(a) != type(b):
+        return False
+    if type(a) == list:
+        return len(a) == len(b) and all(sametype(i, j) for i, j in zip(a, b))
+    if type(a) == dict:
+        return a.keys() == b.keys() and all(sametype(a[k], b[k]) for k in a)
+    return a == b
+
+
+def conformance(n):
+    rnd = random.Random(1234)
+    failures = []
+
+    def check(name, value, result):
+        if not sametype(normalize(value), result):
+            failures.append((name, value, result))
+
+    for _ in range(n):
+        value = randomvalue(rnd)
+        encoded = bencode(value)
+
+        check('bdecode', value, bdecode(encoded))
+
+        view = bdecodeview(encoded)
+        check('bdecodeview', value, view.materialize() if hasattr(view, 'materialize') else view)
+
+        buf = bytearray(rnd.randrange(8))
+        offset = rnd.randrange(len(buf) + 1)
+        length = encode_into(value, buf, offset)
+        if bytes(buf[offset:offset + length]) != encoded:
+            failures.append(('encode_into', value, bytes(buf)))
+
+        results = []
+        decoder = StreamDecoder(lambda result, conn_handle: results.append(result))
+        stream = encoded + encoded
+        mtu = rnd.randrange(1, 24)
+        for i in range(0, len(stream), mtu):
+            decoder.feed(stream[i:i + mtu])
+        if len(results) != 2:
+            failures.append(('StreamDecoder', value, results))
+        for result in results:
+            check('StreamDecoder', value, result)
+
+    # the extension types must keep their python types
+    for value in (True, False, 0.0, -1.5, 1e-07, 1e+22, 123456.789, [True, 1, 1.0]):
+        check('extension', value, bdecode(bencode(value)))
+
+    # malformed input is rejected, by returning False or raising BencodeFailure
+    for malformed in (b'i03e', b'i-0e', b'ie', b'5:abc', b'l', b'x', b'i1ei2e', b'l-3:e', b'd-3:e'):
+        for decode in (bdecode, bdecodeview):
+            try:
+                result = decode(malformed)
+            except BencodeFailure:
+                result = False
+            if result is not False:
+                failures.append(('malformed', malformed, result))
+
+    # nesting too deep for the stack is rejected by the view decoder of the datagrams
+    deep = b'l' * 1500 + b'e' * 1500
+    if bdecodeview(deep) is not False:
+        failures.append(('malformed', 'nested 1500 deep', True))
+
+    return failures
+
+
+########################################
+# Payloads
+########################################
+
+def payloads():
+    """representative reactor packets"""
+    if '1' not in store.models:
+        addmodel(Product())
+    product = store.models['1']
+
+    announce = [nodekey, 0, 'adddescription', product.toDescription()]
+    shadow = [nodekey, 'listenernode', 'addshadow', store.toDict()['models']]
+    updates = [[nodekey, 'othernode', 'updatemodel', '1', 'volume', i, nodekey + '1volume']
+               for i in range(100)]
+
+    return [('announce', [announce]), ('addshadow', [shadow]), ('updatemodel x100', updates)]
+
+
+########################################
+# Benchmarks
+########################################
+
+def measure(fn, packets, nbytes, seconds):
+    """runs fn over the packets for about seconds, returns the rates"""
+    count, start = 0, time.perf_counter()
+    while True:
+        fn(packets)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            break
+
+    # heap cost of one pass, results are kept alive so retained blocks count
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    results = fn(packets)
+    blocks = sys.getallocatedblocks() - blocks
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+
+    return (count * nbytes / elapsed, count * len(packets) / elapsed,
+            blocks / len(packets), peak / len(packets))
+
+
+def report(name, rates):
+    bps, pps, blocks, peak = rates
+    print('{:<38} {:>10.0f} kB/s {:>10.0f} pkt/s {:>8.1f} blocks/pkt {:>9.0f} peak B/pkt'.format(
+        name, bps / 1000, pps, blocks, peak))
+
+
+def encodeall(packets):
+    return [bencode(p) for p in packets]
+
+
+writer = BencodeWriter(4096)
+
+
+def writeall(packets):
+    for p in packets:
+        writer.encode(p)
+    return writer.view()
+
+
+def streamall(mtu):
+    def stream(chunked):
+        results = []
+        decoder = StreamDecoder(lambda result, conn_handle: results.append(result))
+        for chunks in chunked:
+            for chunk in chunks:
+                decoder.feed(chunk)
+        return results
+    return stream
+
+
+def benchmark(seconds):
+    cases = payloads()
+    print('{:<38} {:>15} {:>16} {:>19} {:>20}'.format('benchmark', 'throughput', 'rate', 'retained', 'peak'))
+
+    for name, packets in cases:
+        encoded = encodeall(packets)
+        nbytes = sum(len(e) for e in encoded)
+
+        report('bencode ' + name, measure(encodeall, packets, nbytes, seconds))
+        report('BencodeWriter ' + name, measure(writeall, packets, nbytes, seconds))
+        report('bdecode ' + name, measure(lambda e: [bdecode(x) for x in e], encoded, nbytes, seconds))
+        report('bdecodeview route ' + name,
+               measure(lambda e: [bdecodeview(x)[2] for x in e], encoded, nbytes, seconds))
+
+        for mtu in (20, 185, 512):
+            chunked = [list(encodeTransformer(p, mtu)) for p in packets]
+            report('StreamDecoder mtu {} {}'.format(mtu, name),
+                   measure(streamall(mtu), chunked, nbytes, seconds))
+
+
+if __name__ == "__main__":
+    quick = '--quick' in sys.argv
+
+    failures = conformance(200 if quick else 2000)
+    for failure in failures[:10]:
+        print('FAIL', *failure)
+    print('conformance: {} failures'.format(len(failures)))
+
+    benchmark(0.1 if quick else 1.0)
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,136 @@
+"""
+Two agents exchanging reliable commands through the udp transport over a
+lossy, duplicating link, runs on CPython
+
+    python bench/reliablesim.py
+
+Each agent has its own ReliableChannel, RoutingTable and sendqueue. They are
+swapped into lib.udptransport in turn, so sendudp and receiveudp do the
+wrapping, the compact encoding, the ack routing and the unwrapping.
+The link is a socket stub that drops, duplicates and reorders datagrams
+on a virtual clock. Every command must be delivered exactly once.
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib import fragment, reliable, routingtable, udptransport, wireformat
+from lib.reliable import ReliableChannel
+from lib.ringbuffer import RingBuffer
+from lib.routingtable import RoutingTable
+
+clock = [0] # the virtual clock, in ms
+for module in (reliable, routingtable, fragment):
+    module.ticks_ms = lambda: clock[0]
+
+
+class LossyLink():
+    """a datagram link that drops, duplicates and reorders"""
+
+    def __init__(self, loss, duplication, seed=1):
+        self.loss = loss
+        self.duplication = duplication
+        self.rnd = random.Random(seed)
+        self.sockets = {} # address -> LossySocket
+        self.inflight = []
+        self.datagrams = 0
+
+    def send(self, data, fro, to):
+        self.datagrams += 1
+        data = bytes(data) # the transport sends views of its reusable buffer
+        if self.rnd.random() >= self.loss:
+            self.inflight.append((to, data, fro))
+        if self.rnd.random() < self.duplication:
+            self.inflight.append((to, data, fro))
+
+    def deliver(self):
+        datagrams, self.inflight = self.inflight, []
+        self.rnd.shuffle(datagrams)
+        for to, data, fro in datagrams:
+            if to in self.sockets:
+                self.sockets[to].inbox.append((data, fro))
+
+
+class LossySocket():
+    """the socket of an agent on a lossy link"""
+
+    def __init__(self, link, address):
+        self.link = link
+        self.address = address
+        self.inbox = []
+        link.sockets[address] = self
+
+    def sendto(self, data, address):
+        self.link.send(data, self.address, address)
+
+    def recvfrom(self, size):
+        data, address = self.inbox.pop(0)
+        return (data[:size], address)
+
+
+class Agent():
+    """the transport state of a node"""
+
+    def __init__(self, nodeid, link, address):
+        self.nodeid = nodeid
+        self.sock = LossySocket(link, address)
+        self.channel = ReliableChannel()
+        self.rt = RoutingTable()
+        self.sendqueue = RingBuffer(512, 'dropnewest')
+        self.delivered = []
+
+    def activate(self):
+        """swaps the state of this agent into the transport"""
+        udptransport.nodekey = self.nodeid
+        udptransport.channel = self.channel
+        udptransport.rt = self.rt
+        udptransport.sendqueue = self.sendqueue
+        udptransport.accepts = lambda packet: packet[1] == self.nodeid
+        udptransport.receive = self.receive
+
+    def receive(self, packet):
+        self.delivered.append(packet)
+        return True
+
+
+# the stub socket is always pollable
+udptransport.readable = lambda sock: len(sock.inbox) > 0
+
+
+def simulate(loss, duplication, commands=200, tick=20, ticks=2000):
+    link = LossyLink(loss, duplication)
+    agents = {'A': Agent('A', link, ('10.0.0.1', 3300)), 'B': Agent('B', link, ('10.0.0.2', 3300))}
+    # discovered and negotiated, so the frames travel in the compact encoding
+    agents['A'].rt.seen('B', agents['B'].sock.address)
+    agents['B'].rt.seen('A', agents['A'].sock.address)
+    for nodeid in agents:
+        wireformat.acceptpeer(nodeid, wireformat.version)
+
+    for i in range(commands):
+        agents['A'].sendqueue.append(('A', 'B', 'addwirelistener', 'A/1/p', 'B/1/{}'.format(i)))
+
+    for _ in range(ticks):
+        clock[0] += tick
+        link.deliver()
+        for agent in agents.values():
+            agent.activate()
+            udptransport.receiveudp(agent.sock, 64)
+            udptransport.sendudp(agent.sock)
+
+    delivered = [packet[4] for packet in agents['B'].delivered]
+    unique = len(set(delivered))
+    return unique, len(delivered) - unique, link.datagrams, agents['A'].channel.stats(), agents['B'].channel.stats()
+
+
+if __name__ == "__main__":
+    ok = True
+    for loss, duplication in ((0.0, 0.0), (0.1, 0.05), (0.3, 0.1)):
+        unique, duplicates, datagrams, sender, receiver = simulate(loss, duplication)
+        ok = ok and unique == 200 and duplicates == 0
+        print('loss {:>4.0%} duplication {:>4.0%}: delivered {}/200, duplicates {}, datagrams {}, '
+              'retransmits {}, failed {}, suppressed {}'.format(
+                  loss, duplication, unique, duplicates, datagrams,
+                  sender['retransmits'], sender['failed'], receiver['duplicates']))
+    sys.exit(0 if ok else 1)
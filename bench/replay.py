@@ -0,0 +1,182 @@
+"""
+Replays a recording of the GPS uart, gyro and compass through the GPS
+parser and the course fusion of _main, runs on CPython
+
+    python bench/replay.py record.bin [--speed 10]
+    python bench/replay.py --synthetic [seconds] [--save record.bin]
+
+Recordings are made on the buoy by lib/recorder.py. The synthetic
+recording is a seeded boat run, NMEA at 10 Hz, gyro at 20 Hz and compass
+at 2 Hz, so the replay is repeatable as a regression benchmark.
+By default the replay runs as fast as possible, --speed scales real time.
+The report holds the parse throughput and the control loop outputs.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib.gpsparser import GPS
+from lib.recorder import COMPASS, GYRO, UART, Recorder, records
+from lib.steeringPID import SteeringPID
+
+
+########################################
+# Synthetic recording
+########################################
+
+def nmea(body):
+    """a sentence with its checksum"""
+    crc = 0
+    for c in body:
+        crc ^= ord(c)
+    return '${}*{:02X}\r\n'.format(body, crc).encode()
+
+
+def dm(value, degreedigits):
+    """micro degrees to the NMEA ddmm.mmmmm digits and hemisphere"""
+    hemi = ('N', 'S') if degreedigits == 2 else ('E', 'W')
+    hemi = hemi[0] if value >= 0 else hemi[1]
+    value = abs(value)
+    minutes_e5 = (value % 1000000) * 6
+    return '{:0{}d}{:02d}.{:05d}'.format(value // 1000000, degreedigits,
+                                         minutes_e5 // 100000, minutes_e5 % 100000), hemi
+
+
+def synthetic(filename, seconds=60, seed=1):
+    """records a seeded boat run, at 3 knots on a slowly turning course"""
+    rnd = random.Random(seed)
+    recorder = Recorder(filename, maxbytes=1 << 30)
+    lat, lon = 49693950, 10827610
+    course, speed = 45.0, 3.0
+
+    for tick in range(0, seconds * 1000, 50):
+        turn = 2.0 * ((tick // 10000) % 2 * 2 - 1)  # deg/s, alternating every 10s
+        course = (course + turn * 0.05) % 360
+        recorder.gyro(turn + rnd.gauss(0, 0.5), 0.05, tick)
+
+        if tick % 500 == 0:
+            recorder.compass(((course + rnd.gauss(0, 3)) + 180) % 360 - 180, tick)
+
+        if tick % 100 == 0:
+            # 3 knots is about 1.54 m/s, 0.154 m per 100ms
+            lat += int(1.54 * 0.1 * 1000000 / 111320 * (1 if 0 <= course < 90 or course > 270 else -1))
+            lon += int(1.54 * 0.1 * 1000000 / 73000)
+            hms = '{:02d}{:02d}{:05.2f}'.format(12, tick // 60000, (tick % 60000) / 1000)
+            latdm, lathemi = dm(lat, 2)
+            londm, lonhemi = dm(lon, 3)
+            data = (nmea('GNRMC,{},A,{},{},{},{},{:.1f},{:.1f},170926,,,A'.format(
+                        hms, latdm, lathemi, londm, lonhemi, speed + rnd.gauss(0, 0.2), course)) +
+                    nmea('GNGGA,{},{},{},{},{},1,09,{:.1f},101.5,M,46.9,M,,'.format(
+                        hms, latdm, lathemi, londm, lonhemi, 0.8 + rnd.random())))
+            if tick % 1000 == 0:
+                data += nmea('GNGSA,A,3,04,05,09,12,24,25,29,31,,,,,1.8,0.9,1.5')
+                data += nmea('GPGSV,1,1,04,04,40,083,46,05,17,308,41,09,07,030,40,12,66,275,45')
+            # the uart delivers in arbitrary chunks, not per sentence
+            cut = rnd.randrange(len(data))
+            recorder.uart(data[:cut], tick)
+            recorder.uart(data[cut:], tick + 5)
+
+    recorder.close()
+
+
+########################################
+# Replay
+########################################
+
+def replay(data, speed=0):
+    """feeds the records to the parser and the fusion, in the way the tasks of _main do"""
+    gps = GPS()
+    steeringPID = SteeringPID()
+    desiredcourse = 0
+
+    parsetime = 0.0
+    uartbytes = 0
+    sentences = 0
+    steering = []
+    fusions = {'gps': 0, 'compass': 0, 'gyro': 0}
+
+    first = None
+    start = time.perf_counter()
+    for kind, ticks, payload in records(data):
+        if speed:  # scaled real time
+            first = ticks if first is None else first
+            delay = (ticks - first) / 1000 / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if kind == UART:  # readGps and fuseGps
+            fixes = gps.fixes
+            t = time.perf_counter()
+            sentences += len(gps.parsesentence(payload))
+            parsetime += time.perf_counter() - t
+            uartbytes += len(payload)
+            if gps.fixes != fixes and gps.positionvalid and gps.speed >= 1.5:
+                steeringPID.fusegps(gps.course)
+                fusions['gps'] += 1
+
+        elif kind == COMPASS:  # fuseCompass
+            steeringPID.fusecompass(payload[0])
+            fusions['compass'] += 1
+
+        elif kind == GYRO:  # steerCourse
+            gyro_z, deltaT = payload
+            currentcourse = steeringPID.fusegyro(gyro_z, deltaT)
+            steering.append(steeringPID.pidloop(desiredcourse, currentcourse, deltaT))
+            fusions['gyro'] += 1
+
+    elapsed = time.perf_counter() - start
+    return {
+        'elapsed': elapsed,
+        'parsetime': parsetime,
+        'uartbytes': uartbytes,
+        'sentences': sentences,
+        'gps': gps,
+        'steering': steering,
+        'course': steeringPID.currentcourse,
+        'fusions': fusions
+    }
+
+
+def report(result):
+    gps = result['gps']
+    parsetime = result['parsetime'] or 1e-9
+    steering = result['steering'] or [0]
+    print('replay: {:.3f}s'.format(result['elapsed']))
+    print('parse: {} bytes, {} sentences in {:.3f}s, {:.0f} bytes/s, {:.0f} sentences/s'.format(
+        result['uartbytes'], result['sentences'], parsetime,
+        result['uartbytes'] / parsetime, result['sentences'] / parsetime))
+    print('gps: {} fixes, {} crc fails, hdop {}, fix quality {}, sentences {}'.format(
+        gps.fixes, gps.crc_fails, gps.hdop, gps.fix_quality, gps.sentence_counts))
+    print('fusion: {}'.format(result['fusions']))
+    # the control loop outputs, compare them between runs to catch a change of behaviour
+    print('control: {} steps, steering min {:.3f} mean {:.3f} max {:.3f}, final course {:.3f}'.format(
+        len(result['steering']), min(steering), sum(steering) / len(steering), max(steering), result['course']))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    speed = 0
+    if '--speed' in args:
+        speed = float(args[args.index('--speed') + 1])
+
+    if '--synthetic' in args:
+        i = args.index('--synthetic')
+        seconds = int(args[i + 1]) if i + 1 < len(args) and args[i + 1].isdigit() else 60
+        filename = args[args.index('--save') + 1] if '--save' in args else 'synthetic.bin'
+        synthetic(filename, seconds)
+        remove = '--save' not in args
+    elif len(args) and not args[0].startswith('--'):
+        filename, remove = args[0], False
+    else:
+        print(__doc__)
+        sys.exit(2)
+
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if remove:
+        os.remove(filename)
+
+    report(replay(data, speed))
@@ -7,7 +7,7 @@ from drivers.imu import IMU
 from drivers.thruster import Thruster
 from drivers.bleuart import BLEUART
 #from drivers.mqtt import MQTTClient
-from lib.gps import GPS
+from lib.gpsparser import GPS
 from lib.steeringPID import SteeringPID
 from lib.bencode import bdecode, bencode
 from lib.server import Server
@@ -21,31 +21,54 @@ bleuart = BLEUART('RoboBuoy')
 bleuartLock = asyncio.Lock()
 server = Server()
 
-#Hardware serial port 2 for GPS sentences
-gpsuart = UART(2, baudrate=9600, bits=8, parity=None, stop=1, tx=5, rx=13, rts=-1, cts=-1, txbuf=256, rxbuf=256, timeout=0, timeout_char=2)
+#Hardware serial port 2 for GPS sentences, the rxbuf holds about 1s of sentences at 9600 baud
+gpsuart = UART(2, baudrate=9600, bits=8, parity=None, stop=1, tx=5, rx=13, rts=-1, cts=-1, txbuf=256, rxbuf=1024, timeout=0, timeout_char=2)
 gps = GPS()
+gpsfix = asyncio.Event() # set on every new fix, consumers wake on it
+gpsstats = {'reads':0, 'bytes':0, 'overruns':0}
+GPS_READ = 512 # bytes per read, a read that comes back full means the reader is falling behind the uart
 
 steeringPID = SteeringPID()
 
+recorder = None # lib.recorder.Recorder('record.bin') records the gps, gyro and compass input, for bench/replay.py
+
 thruster = Thruster()
 thruster.arm()
 
 
+async def readGps():
+    try:
+        print('readGps started')
+        reader = asyncio.StreamReader(gpsuart)
+        while True:
+
+            #wait for the uart, and parse all the sentences received
+            data = await reader.read(GPS_READ)
+            if recorder:
+                recorder.uart(data)
+            gpsstats['reads'] += 1
+            gpsstats['bytes'] += len(data)
+            if len(data) >= GPS_READ:
+                gpsstats['overruns'] += 1
+
+            fixes = gps.fixes
+            gps.parsesentence( data )
+
+            if gps.fixes != fixes:
+                gpsfix.set()
+
+    except asyncio.CancelledError:
+        print( "readGps Stopped" )
+
+
 async def fuseGps():
     try:
         print('fuseGps started')
         while True:
-            
-            await asyncio.sleep_ms(1000)  
-            
-            #read the gps sentense for the uart
-            gpssentence = gpsuart.readline()
-
-            if gpssentence == None:
-                continue
 
-            #parse the gps sentence    
-            gps.parsesentence( gpssentence )
+            #wake on a new fix
+            await gpsfix.wait()
+            gpsfix.clear()
 
             if gps.positionvalid == False:
                 continue
@@ -68,6 +91,8 @@ async def fuseCompass():
 
             # read magnetic compass heading
             compasscourse = imu.readMagHeading()
+            if recorder:
+                recorder.compass(compasscourse)
             steeringPID.fusecompass(compasscourse)
             await asyncio.sleep_ms(500)  
     
@@ -85,6 +110,8 @@ async def steerCourse():
 
             # read gyro angualr velocities in deg_s and the time between readings deltaT
             _,_,gyro_z,deltaT = imu.readCalibractedGyro()
+            if recorder:
+                recorder.gyro(gyro_z, deltaT)
 
             currentcourse = steeringPID.fusegyro(gyro_z,deltaT)
 
@@ -103,11 +130,10 @@ async def receive_message():
     ''' receives messages via bluetooth '''
     try:
         while True:
-            if bleuart.message != None:
-                server.receive( bleuart.message )
-                server.react() #TODO this may need its own async co-routine
-            # clear processed message          
-            bleuart.message = None
+            # drain all the messages received since the last wake
+            while len(bleuart.messages):
+                server.receive( bleuart.messages.popleft() )
+            server.react() #TODO this may need its own async co-routine
             await bleuart.received_event.wait()
             
             
@@ -142,16 +168,20 @@ async def main_task():
     # Start the Tasks
     #steerCourse_Task = asyncio.create_task( steerCourse() )
     #fuseCompass_Task = asyncio.create_task( fuseCompass() )
+    #readGps_Task     = asyncio.create_task( readGps() )
     #fuseGps_Task     = asyncio.create_task( fuseGps() )
     receive_message_Task = asyncio.create_task( receive_message() )
     send_message_Task = asyncio.create_task( send_message() )
     await asyncio.sleep(100000)  # Pause 1s    
     # Stop the Tasks
     #fuseGps_Task.cancel()
+    #readGps_Task.cancel()
     #fuseCompass_Task.cancel()
     #steerCourse_Task.cancel()
     receive_message_Task.cancel()
     send_message_Task.cancel()
+    if recorder:
+        recorder.close()
     
         
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 from config import nodekey
-from lib.reactor import send
+from lib.reactor import send, requestresync
 
 
 def doaction(packet):
@@ -15,13 +15,17 @@ def discover(nodeid):
     """discovery of nodes onthe network by requesting other nodees to annouce-"""
     send(nodekey, nodeid or 0, 'announce')
 
+def routes(nodeid):
+    """inspect the routing table of a node"""
+    send(nodekey, nodeid, 'routes')
+
 def updatemodel(nodeid, modelid, prop, value, salt='0'):
     """set a property value of a local or remote model"""
     send(nodekey, nodeid, 'updatemodel', modelid, prop, value, salt)
 
 def shadow(nodeid):
-    """shadow another node"""
-    send(nodekey, nodeid, 'addshadowlistener', nodekey)
+    """shadow another node, a shadow already held is resynced with the changes only"""
+    requestresync(nodeid, True)
 
 def unshadow(nodeid):
     """unshadow another node"""
@@ -48,6 +52,7 @@ def removemodel(nodeid,modelid):
 """actions that doactions may do"""
 actions = {
     'discover': discover,
+    'routes': routes,
     'updatemodel': updatemodel,
     'shadow': shadow,
     'unshadow': unshadow,
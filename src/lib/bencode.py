@@ -2,6 +2,16 @@ class BencodeFailure(Exception):
     pass
 
 
+_LIST = ord("l")
+_DICT = ord("d")
+_END = ord("e")
+_INT = ord("i")
+_FLOAT = ord("f")
+_BOOL = ord("j")
+_STRLEN = ord(":")
+MAXDEPTH = 32  # nesting of lists and dicts a view decodes, deeper data is malformed
+
+
 def decode_int(x, f):
     f += 1
     newf = x.index(bytes("e", "utf-8"), f)
@@ -115,89 +125,355 @@ def bdecode(x):
     return r
 
 
-def encode_int(x):
-    result = bytearray()
-    result.append(ord("i"))
-    result.extend(bytes(str(x), "utf-8"))
-    result.append(ord("e"))
-    return result
+def view_number(x, f, term, signed=False):
+    """parses a decimal integer in place, from f up to the terminator byte,
+    only signed numbers may have a '-', a string length may not"""
+    negative = x[f] == 45  # '-'
+    if negative and not signed:
+        raise ValueError
+    if negative:
+        f += 1
+    start, n = f, 0
 
-def encode_float(x):
-    result = bytearray()
-    result.append(ord("f"))
-    result.extend(bytes(str(x), "utf-8"))
-    result.append(ord("e"))
-    return result    
+    c = x[f]
+    while c != term:
+        if c < 48 or c > 57:
+            raise ValueError
+        n = n * 10 + c - 48
+        f += 1
+        c = x[f]
 
+    if f == start:
+        raise ValueError
+    if x[start] == 48 and (negative or f != start + 1):  # leading zero
+        raise ValueError
 
-def encode_bool(x):
-    result = bytearray()
+    return (-n if negative else n, f + 1)
 
-    result.append(ord("j"))
 
-    if x:
-        result.extend(bytes(str(1), "utf-8"))
-    else:
-        result.extend(bytes(str(0), "utf-8"))
+def view_end(x, f):
+    """returns the offset of the next 'e' terminator"""
+    while x[f] != _END:
+        f += 1
+    return f
 
-    result.append(ord("e"))
 
-    return result
+def decode_view(x, f, depth=0):
+    """decodes the value at f of a memoryview, integers are parsed in place.
+    Nesting deeper than MAXDEPTH raises a ValueError, before the recursion runs out of stack"""
+    c = x[f]
 
+    if c == _INT:
+        return view_number(x, f + 1, _END, True)
 
-def encode_bytes(x):
-    result = bytearray()
-    result.extend(bytes("{}:".format(len(x)), "utf-8"))
-    result.extend(x)
-    return result
+    if c == _BOOL:
+        n, f = view_number(x, f + 1, _END, True)
+        return (n == 1, f)
 
+    if c == _FLOAT:
+        end = view_end(x, f + 1)
+        return (float(bytes(x[f + 1:end])), end + 1)
 
-def encode_string(x):
-    return encode_bytes(bytes(x, "utf-8"))
+    if c == _LIST:
+        if depth >= MAXDEPTH:
+            raise ValueError
+        r, f = [], f + 1
+        while x[f] != _END:
+            v, f = decode_view(x, f, depth + 1)
+            r.append(v)
+        return (r, f + 1)
+
+    if c == _DICT:
+        if depth >= MAXDEPTH:
+            raise ValueError
+        r, f = {}, f + 1
+        while x[f] != _END:
+            k, f = decode_view(x, f, depth + 1)
+            r[k], f = decode_view(x, f, depth + 1)
+        return (r, f + 1)
+
+    n, f = view_number(x, f, _STRLEN)
+    if f + n > len(x):
+        raise ValueError
+    return (str(x[f:f + n], 'utf-8'), f + n)
 
 
-def encode_list(x):
-    result = bytearray()
+def skip_view(x, f, depth=0):
+    """returns the offset after the value at f, without materialising it,
+    nesting deeper than MAXDEPTH raises a ValueError"""
+    c = x[f]
 
-    result.append(ord("l"))
+    if c == _INT or c == _BOOL or c == _FLOAT:
+        return view_end(x, f + 1) + 1
 
-    for i in x:
-        result.extend(encode_func[type(i)](i))
+    if c == _LIST or c == _DICT:
+        if depth >= MAXDEPTH:
+            raise ValueError
+        f += 1
+        while x[f] != _END:
+            f = skip_view(x, f, depth + 1)
+        return f + 1
 
-    result.append(ord("e"))
+    n, f = view_number(x, f, _STRLEN)
+    if f + n > len(x):
+        raise ValueError
+    return f + n
 
-    return result
 
+def lazy_view(x, f):
+    """returns lazy proxies for lists and dicts, decodes other values"""
+    c = x[f]
+    if c == _LIST:
+        r = LazyList(x, f)
+        return (r, r.end)
+    if c == _DICT:
+        r = LazyDict(x, f)
+        return (r, r.end)
+    return decode_view(x, f)
 
-def encode_dict(x):
-    result = bytearray()
 
-    result.append(ord("d"))
+class LazyList():
+    '''
+    Read only list over a bencoded list in a buffer.
+    Items are decoded when they are accessed, so a packet can be
+    routed on packet[1] and packet[2] without decoding its payload
+    '''
+
+    def __init__(self, x, f):
+        self.x = x
+        self.offsets = []  # offset of each item in x
+        f += 1
+        while x[f] != _END:
+            self.offsets.append(f)
+            f = skip_view(x, f)
+        self.end = f + 1
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return decode_view(self.x, self.offsets[i])[0]
+
+    def __iter__(self):
+        for f in self.offsets:
+            yield decode_view(self.x, f)[0]
+
+    def lazy(self, i):
+        """returns item i, lists and dicts as lazy proxies"""
+        return lazy_view(self.x, self.offsets[i])[0]
+
+    def materialize(self):
+        """decodes all items into a list, detached from the buffer"""
+        return list(self)
+
+
+class LazyDict():
+    '''
+    Read only dict over a bencoded dict in a buffer.
+    Keys are decoded on first access, values when they are accessed
+    '''
+
+    def __init__(self, x, f):
+        self.x = x
+        self.f = f
+        self.index = None  # key -> offset of the value in x
+        self.end = skip_view(x, f)
+
+    def _offsets(self):
+        if self.index is None:
+            x, f, self.index = self.x, self.f + 1, {}
+            while x[f] != _END:
+                k, f = decode_view(x, f)
+                self.index[k] = f
+                f = skip_view(x, f)
+        return self.index
+
+    def __len__(self):
+        return len(self._offsets())
+
+    def __contains__(self, key):
+        return key in self._offsets()
+
+    def __getitem__(self, key):
+        return decode_view(self.x, self._offsets()[key])[0]
+
+    def __iter__(self):
+        return iter(self._offsets())
+
+    def get(self, key, default=None):
+        if key in self._offsets():
+            return self[key]
+        return default
+
+    def keys(self):
+        return self._offsets().keys()
+
+    def items(self):
+        for k, f in self._offsets().items():
+            yield (k, decode_view(self.x, f)[0])
+
+    def lazy(self, key):
+        """returns the value of key, lists and dicts as lazy proxies"""
+        return lazy_view(self.x, self._offsets()[key])[0]
+
+    def materialize(self):
+        """decodes all items into a dict, detached from the buffer"""
+        return decode_view(self.x, self.f)[0]
+
+
+def bdecodeview(x):
+    '''
+    decodes a buffer without copying it, lists and dicts are
+    returned as LazyList and LazyDict proxies over a memoryview of x,
+    so x must not be modified while the result is in use
+    '''
+    x = memoryview(x)
+    try:
+        r, l = lazy_view(x, 0)
+    except (IndexError, KeyError, ValueError):
+        return False
+
+    if l != len(x):
+        raise BencodeFailure("invalid bencoded value (data after valid prefix)")
+
+    return r
 
-    # for k, v in sorted(x.items()):
-    for k, v in x.items():
-        result.extend(encode_string(str(k)))
-        result.extend(encode_func[type(v)](v))
 
-    result.append(ord("e"))
+class BencodeWriter():
+    '''
+    Encodes values directly into one reusable bytearray, instead of
+    building a temporary buffer per value. The buffer grows when needed
+    and is kept between encodes
+    '''
+
+    def __init__(self, size=256, buf=None):
+        self.buf = bytearray(size) if buf is None else buf
+        self.pos = 0  # end of the encoded bytes
+
+    def grow(self, end):
+        """extends the buffer to hold at least end bytes"""
+        self.buf.extend(bytearray(max(end - len(self.buf), len(self.buf))))
+
+    def put(self, data):
+        end = self.pos + len(data)
+        if end > len(self.buf):
+            self.grow(end)
+        self.buf[self.pos:end] = data
+        self.pos = end
+
+    def putbyte(self, byte):
+        if self.pos == len(self.buf):
+            self.grow(self.pos + 1)
+        self.buf[self.pos] = byte
+        self.pos += 1
+
+    def write(self, x):
+        """appends the encoding of x"""
+        write_func[type(x)](self, x)
+
+    def encode(self, x):
+        """encodes x from the start of the buffer, returns the length"""
+        self.pos = 0
+        write_func[type(x)](self, x)
+        return self.pos
+
+    def view(self):
+        """the encoded bytes as a memoryview, valid until the next encode"""
+        return memoryview(self.buf)[:self.pos]
+
+
+class Encoded():
+    '''
+    Bytes that are already bencoded, they are written as they are,
+    so a cached encoding is embedded in a larger value without
+    encoding it again
+    '''
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+
+def write_encoded(w, x):
+    w.put(x.data)
+
+
+def write_int(w, x):
+    w.putbyte(_INT)
+    w.put(bytes(str(x), "utf-8"))
+    w.putbyte(_END)
+
+
+def write_float(w, x):
+    w.putbyte(_FLOAT)
+    # an upper case exponent, a lower case one would end the token
+    w.put(bytes(str(x).replace("e", "E"), "utf-8"))
+    w.putbyte(_END)
+
+
+def write_bool(w, x):
+    w.putbyte(_BOOL)
+    w.putbyte(ord("1") if x else ord("0"))
+    w.putbyte(_END)
+
+
+def write_bytes(w, x):
+    w.put(bytes(str(len(x)), "utf-8"))
+    w.putbyte(_STRLEN)
+    w.put(x)
 
-    return result
 
+def write_string(w, x):
+    write_bytes(w, bytes(x, "utf-8"))
 
-encode_func = {
-    int: encode_int,
-    float: encode_float,
-    bool: encode_bool,
-    bytes: encode_bytes,
-    str: encode_string,
-    list: encode_list,
-    tuple: encode_list,
-    dict: encode_dict
+
+def write_list(w, x):
+    w.putbyte(_LIST)
+    for i in x:
+        write_func[type(i)](w, i)
+    w.putbyte(_END)
+
+
+def write_dict(w, x):
+    w.putbyte(_DICT)
+    # for k, v in sorted(x.items()):
+    for k, v in x.items():
+        write_string(w, str(k))
+        write_func[type(v)](w, v)
+    w.putbyte(_END)
+
+
+write_func = {
+    int: write_int,
+    float: write_float,
+    bool: write_bool,
+    bytes: write_bytes,
+    str: write_string,
+    list: write_list,
+    tuple: write_list,
+    dict: write_dict,
+    Encoded: write_encoded
 }
 
 
+def encode_into(x, buf, offset=0):
+    '''
+    encodes x into the bytearray buf starting at offset,
+    buf is extended if x does not fit
+    @returns: the number of bytes written
+    '''
+    w = BencodeWriter(buf=buf)
+    w.pos = offset
+    w.write(x)
+    return w.pos - offset
+
+
 def bencode(x):
-    return bytes(encode_func[type(x)](x))
+    w = BencodeWriter()
+    w.write(x)
+    return bytes(w.view())
 
 
 def encodeTransformer(x, mtu):
@@ -214,27 +490,138 @@ def encodeTransformer(x, mtu):
         yield source[i:i+mtu]
 
 
+class StreamDecoder():
+    '''
+    Resumable bencode decoder for chunked streams (BLE, UDP reassembly).
+    Keeps a parse stack and the partially read token between chunks,
+    so every byte of the stream is consumed exactly once. Completed values
+    are passed to the successHandler(result, conn_handle), several values
+    may follow each other in one chunk
+    '''
+
+    def __init__(self, successHandler, conn_handle=None):
+        self.successHandler = successHandler
+        self.conn_handle = conn_handle
+        self.reset()
+
+    def reset(self):
+        """discards any partially decoded value"""
+        self.stack = []  # open lists and dicts, innermost last
+        self.keys = []  # pending dict key of each open container
+        self.token = 0  # type of the scalar being read, 0 when between tokens
+        self.digits = bytearray()  # digits of a number or string length
+        self.remaining = 0  # string bytes still to be read
+        self.strbuf = bytearray()
+
+    def feed(self, chunk):
+        """consumes a chunk of the stream"""
+        try:
+            self._feed(chunk)
+        except (BencodeFailure, ValueError):
+            self.reset()  # drop the corrupt value and the rest of the chunk
+
+    def _feed(self, chunk):
+        view = memoryview(chunk)
+        i, n = 0, len(chunk)
+
+        while i < n:
+
+            if self.remaining:  # inside a string
+                take = min(self.remaining, n - i)
+                self.strbuf.extend(view[i:i + take])
+                self.remaining -= take
+                i += take
+                if self.remaining == 0:
+                    self._value(str(self.strbuf, 'utf-8'))
+                continue
+
+            if self.token:  # inside an int, float, bool or string length
+                end = chunk.find(b':' if self.token == _STRLEN else b'e', i)
+                if end == -1:
+                    self.digits.extend(view[i:])
+                    return
+                self.digits.extend(view[i:end])
+                i = end + 1
+                self._scalar()
+                continue
+
+            c = chunk[i]
+
+            if c == _LIST:
+                self.stack.append([])
+                self.keys.append(None)
+                i += 1
+            elif c == _DICT:
+                self.stack.append({})
+                self.keys.append(None)
+                i += 1
+            elif c == _END:
+                if len(self.stack) == 0 or self.keys[-1] is not None:
+                    raise BencodeFailure("unexpected end of container")
+                self.keys.pop()
+                i += 1
+                self._value(self.stack.pop())
+            elif c == _INT or c == _FLOAT or c == _BOOL:
+                self.token = c
+                i += 1
+            elif 48 <= c <= 57:  # string length starts with a digit
+                self.token = _STRLEN
+            else:
+                raise BencodeFailure("invalid bencoded stream")
+
+    def _scalar(self):
+        """converts the collected digits of the current token"""
+        token, digits = self.token, bytes(self.digits)
+        self.token = 0
+        self.digits = bytearray()
+
+        if token == _FLOAT:
+            return self._value(float(digits))
+
+        if len(digits) == 0:
+            raise ValueError
+        if len(digits) > 1 and digits[0] == ord("0"):
+            raise ValueError
+        if digits[0:2] == b"-0":
+            raise ValueError
+
+        n = int(digits)
+
+        if token == _INT:
+            self._value(n)
+        elif token == _BOOL:
+            self._value(n == 1)
+        elif n == 0:
+            self._value('')
+        else:
+            self.remaining = n
+            self.strbuf = bytearray()
+
+    def _value(self, value):
+        """places a completed value into its container, or emits it"""
+        if len(self.stack) == 0:
+            return self.successHandler(value, self.conn_handle)
+
+        container = self.stack[-1]
+
+        if type(container) == list:
+            container.append(value)
+        elif self.keys[-1] is None:
+            if type(value) != str:
+                raise BencodeFailure("dictionary keys must be strings")
+            self.keys[-1] = value
+        else:
+            container[self.keys[-1]] = value
+            self.keys[-1] = None
+
+
 def decodeTransformer(successHandler, conn_handle=None):
     '''
     The decodeTransformer allows a stream of 
-    bytes to be accumulated, the successHandler
-    is called with the sucessful result
+    bytes to be decoded incrementally, the successHandler
+    is called with each sucessful result
     '''
-    accumulator = b''
-    
-    def decodeChunk( chunk ):
-        nonlocal accumulator
-        accumulator = accumulator + chunk
-    
-        try:
-            result = bdecode(accumulator)
-            if result:
-                accumulator = b''
-                successHandler( result, conn_handle)
-        except BencodeFailure:
-            pass
-    
-    return decodeChunk 
+    return StreamDecoder(successHandler, conn_handle).feed
 
 
 
@@ -1,13 +1,14 @@
 import uasyncio as asyncio
 import ubluetooth
-from lib.bencode import bencode
+from lib.bencode import BencodeWriter, StreamDecoder
+from lib.ringbuffer import RingBuffer
 
 class BLEUART():
     '''Bluetooth Low Energy - Nordic UART Service (NUS)'''
     def __init__(self, name="RoboBuoy"):   
         self.mtu = 20 # maximum transmissuin unit (ble is 20 bytes payload)
         self.name = name
-        self.message = None
+        self.messages = RingBuffer(16, 'dropoldest') # decoded messages, drained by the receiver task
         self.ble = ubluetooth.BLE()
         self.ble.active(True)
         self.ble.irq(self.ble_irq)
@@ -22,11 +23,14 @@ class BLEUART():
 
         # A resource lock for BLEUART
         self.lock = asyncio.Lock()
-        # A b-encode decode Transformer
-        self.decoder = bencode.decodeTransformer(self.message_received,0)     
+        # A resumable b-encode stream decoder, fed by the ble irq
+        self.decoder = StreamDecoder(self.message_received,0)
+        # A reusable b-encode buffer for notifications, guarded by the lock
+        self.writer = BencodeWriter(512)
         
     def message_received(self, result, conn_handle):
-        self.message = result
+        ''' queues a decoded message, one chunk may hold several '''
+        self.messages.append(result)
         self.received_event.set()
 
     def ble_irq(self, event, data):
@@ -38,14 +42,14 @@ class BLEUART():
  
         elif event == 2:
             '''CENTRAL_DISCONNECT'''
+            self.decoder.reset() # drop a partially received message
             self.advertise()
             self.disconnect_event.set()
       
         elif event == 3:
             '''GATTS_WRITE message received'''            
             chunk = self.ble.gatts_read(self.rx)
-            print(chunk)
-            self.decoder(chunk)
+            self.decoder.feed(chunk)
 
         elif event == 21:
             '''MTU Exchanged'''
@@ -80,11 +84,12 @@ class BLEUART():
         if len(data) == 0:
             return False
 
-        generator = bencode.encodeTransformer(data,self.mtu)
+        length = self.writer.encode(data)
+        view = self.writer.view()
         
-        for chunk in generator:
+        for i in range(0, length, self.mtu):
             try:
-                self.ble.gatts_notify(0, self.tx, chunk )
+                self.ble.gatts_notify(0, self.tx, view[i:i+self.mtu] )
                 await asyncio.sleep_ms(15)
             except OSError:
                 pass
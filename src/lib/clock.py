@@ -0,0 +1,16 @@
+"""
+Millisecond ticks, for both micropython and python37
+"""
+try:
+    from time import ticks_ms, ticks_diff, ticks_add
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(new, old):
+        return new - old
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
@@ -0,0 +1,69 @@
+from lib.clock import ticks_ms, ticks_diff, ticks_add
+
+
+class Coalescer():
+    '''
+    Holds back packets that supersede each other, such as property
+    updates, per destination node. Only the latest packet per key is
+    sent when the flush interval of the destination is due.
+    '''
+
+    def __init__(self, key, interval=100):
+        self.key = key  # key(packet), None if the packet is never held back
+        self.interval = interval  # default flush interval in ms
+        self.intervals = {}  # nodeid -> flush interval in ms, 0 sends immediately
+        self.pending = {}  # nodeid -> {key: packet}
+        self.due = {}  # nodeid -> ticks when the pending packets are sent
+        self.coalesced = 0  # packets superseded before they were sent
+
+    def __len__(self):
+        return sum(len(packets) for packets in self.pending.values())
+
+    def setinterval(self, nodeid, interval):
+        """sets the flush interval in ms of a destination, None restores the default"""
+        if interval is None:
+            if (nodeid in self.intervals) == True:
+                del self.intervals[nodeid]
+        else:
+            self.intervals[nodeid] = interval
+
+    def put(self, packet, now=None):
+        """holds back a packet, returns False if it is not to be coalesced"""
+        nodeid = packet[1]
+        interval = self.intervals.get(nodeid, self.interval)
+        if interval <= 0:
+            return False
+
+        k = self.key(packet)
+        if k is None:
+            return False
+
+        if (nodeid in self.pending) == False:
+            self.pending[nodeid] = {}
+            self.due[nodeid] = ticks_add(ticks_ms() if now is None else now, interval)
+
+        packets = self.pending[nodeid]
+        if (k in packets) == True:
+            self.coalesced += 1
+        packets[k] = packet  # last value wins
+        return True
+
+    def flush(self, queue, now=None, force=False):
+        """appends the due packets to the queue, returns the number of packets appended"""
+        now = ticks_ms() if now is None else now
+        flushed = 0
+        for nodeid in list(self.pending):
+            if force or ticks_diff(now, self.due[nodeid]) >= 0:
+                for packet in self.pending[nodeid].values():
+                    queue.append(packet)
+                    flushed += 1
+                del self.pending[nodeid]
+                del self.due[nodeid]
+        return flushed
+
+    def nextdue(self, now=None):
+        """ms until the next destination is due, None if nothing is held back"""
+        if len(self.due) == 0:
+            return None
+        now = ticks_ms() if now is None else now
+        return max(0, min(ticks_diff(due, now) for due in self.due.values()))
@@ -0,0 +1,104 @@
+from lib.clock import ticks_ms, ticks_diff
+
+
+def fragments(data, size):
+    """
+    Generator, splits bencoded bytes into strings of at most size bytes.
+    The splits fall on utf-8 character boundaries, so each fragment
+    is a valid string
+    """
+    n, i = len(data), 0
+    while i < n:
+        end = min(n, i + size)
+        while end < n and (data[end] & 0xC0) == 0x80:  # a utf-8 continuation byte
+            end -= 1
+        yield str(data[i:end], 'utf-8')
+        i = end
+
+
+class Reassembler():
+    '''
+    Collects the fragments of messages that are larger than one datagram.
+    Incomplete messages are dropped after timeout ms, or when the
+    fragments held exceed maxbytes, oldest first
+    '''
+
+    def __init__(self, timeout=3000, maxbytes=16384, maxfragments=64):
+        self.timeout = timeout
+        self.maxbytes = maxbytes
+        self.maxfragments = maxfragments
+        self.messages = {}  # (fro, msgid) -> [since, chunks, received, nbytes]
+        self.nbytes = 0
+
+        # statistics
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalid = 0
+
+    def add(self, fro, msgid, index, count, chunk, now=None):
+        """adds a fragment, returns the bytes of the message when it is complete, else None"""
+        now = ticks_ms() if now is None else now
+
+        if count < 1 or count > self.maxfragments or index < 0 or index >= count or len(chunk) > self.maxbytes:
+            self.invalid += 1
+            return None
+
+        key = (fro, msgid)
+        if (key in self.messages) == False:
+            self.messages[key] = [now, [None] * count, 0, 0]
+        message = self.messages[key]
+        chunks = message[1]
+
+        if len(chunks) != count:
+            self.invalid += 1
+            return None
+        if chunks[index] is not None:
+            return None  # a duplicate fragment
+
+        chunks[index] = chunk
+        message[2] += 1
+        message[3] += len(chunk)
+        self.nbytes += len(chunk)
+
+        if message[2] == count:
+            self.remove(key)
+            self.completed += 1
+            return bytes(''.join(chunks), 'utf-8')
+
+        while self.nbytes > self.maxbytes:  # over the memory cap, drop the oldest message
+            self.remove(self.oldest())
+            self.evicted += 1
+        return None
+
+    def remove(self, key):
+        self.nbytes -= self.messages[key][3]
+        del self.messages[key]
+
+    def oldest(self):
+        oldest = None
+        for key in self.messages:
+            if oldest is None or ticks_diff(self.messages[oldest][0], self.messages[key][0]) > 0:
+                oldest = key
+        return oldest
+
+    def expire(self, now=None):
+        """drops the messages that were not completed in time"""
+        now = ticks_ms() if now is None else now
+        for key in list(self.messages):
+            if ticks_diff(now, self.messages[key][0]) > self.timeout:
+                self.remove(key)
+                self.expired += 1
+
+    def stats(self):
+        return {
+            'incomplete': len(self.messages),
+            'bytes': self.nbytes,
+            'completed': self.completed,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'invalid': self.invalid
+        }
+
+
+reassembler = Reassembler()  # the fragments received by this node
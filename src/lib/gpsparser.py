@@ -1,35 +1,141 @@
-import time
-import uasyncio as asyncio
-from math import sin, cos, sqrt, atan2, degrees, radians
+from lib.clock import ticks_ms
+from math import cos, sqrt, atan2, degrees, radians
 
-__HEMISPHERES = ('N', 'S', 'E', 'W')
+# a single leading underscore, a double one would be name mangled inside the class
+_HEMISPHERES = ('N', 'S', 'E', 'W')
+
+# Max Number of Characters a valid sentence can be, NMEA allows 82
+MAX_SENTENCE = 96
+
+# Positions are integer micro degrees (1e-6), about 11 cm of latitude, the range stays within
+# MicroPython small ints. Local offsets are integer centimetres on a tangent plane at a reference
+CM_PER_MICRODEGREE_E3 = 11132  # centimetres per 1000 micro degrees of latitude
+COS_SCALE = 1024  # scale of the integer cosine of the reference latitude
+
+########################################
+# Field Decoders
+# decoder(gps, segments, index) -> value, None leaves the attribute as it is
+########################################
+
+def _float(gps, f, i):
+    return float(f[i]) if f[i] else None
+
+def _int(gps, f, i):
+    return int(f[i]) if f[i] else None
+
+def _time(gps, f, i):
+    """hhmmss.ss UTC, with the local offset"""
+    if not f[i]:
+        return (0, 0, 0)  # No Time stamp yet
+    return (int(f[i][0:2]) + gps.local_offset, int(f[i][2:4]), float(f[i][4:]))
+
+def _date(gps, f, i):
+    """ddmmyy to (day, month, year), two digit years from 80 are 19xx"""
+    if not f[i]:
+        return None
+    year = int(f[i][4:6])
+    return (int(f[i][0:2]), int(f[i][2:4]), year + (1900 if year >= 80 else 2000))
+
+def _status(gps, f, i):
+    """A is a valid fix, V a warning"""
+    return f[i] == 'A'
+
+def _quality(gps, f, i):
+    """GGA fix quality, 0 is no fix"""
+    return bool(f[i]) and int(f[i]) > 0
+
+def _latitude(gps, f, i):
+    """ddmm.mmmmm and hemisphere to micro degrees"""
+    if not f[i]:
+        return 0
+    if f[i + 1] not in _HEMISPHERES:
+        raise ValueError()
+    return gps.convert_dm_e6(f[i][0:2], f[i][2:], f[i + 1])
+
+def _longitude(gps, f, i):
+    """dddmm.mmmmm and hemisphere to micro degrees"""
+    if not f[i]:
+        return 0
+    if f[i + 1] not in _HEMISPHERES:
+        raise ValueError()
+    return gps.convert_dm_e6(f[i][0:3], f[i][3:], f[i + 1])
+
+def _used(gps, f, i):
+    """the number of satellite ids of the 12 GSA slots"""
+    return len([sv for sv in f[i:i + 12] if sv])
+
+def _inview(gps, f, i):
+    """satellites in view, per talker as GSV is sent per constellation"""
+    gps.satellites_in_view[f[0][0:2]] = int(f[i]) if f[i] else 0
+    return gps.satellites_in_view
+
+# Field Tables, (index, attribute, decoder) per sentence
+RMC_FIELDS = (
+    (1, 'timestamp', _time),
+    (2, 'positionvalid', _status),
+    (3, 'latitude', _latitude),
+    (5, 'longitude', _longitude),
+    (7, 'speed', _float),
+    (8, 'course', _float),
+    (9, 'date', _date)
+)
+
+GGA_FIELDS = (
+    (1, 'timestamp', _time),
+    (2, 'latitude', _latitude),
+    (4, 'longitude', _longitude),
+    (6, 'positionvalid', _quality),
+    (6, 'fix_quality', _int),
+    (7, 'satellites_in_use', _int),
+    (8, 'hdop', _float),
+    (9, 'altitude', _float)
+)
+
+GLL_FIELDS = (
+    (1, 'latitude', _latitude),
+    (3, 'longitude', _longitude),
+    (5, 'timestamp', _time),
+    (6, 'positionvalid', _status)
+)
+
+VTG_FIELDS = (
+    (1, 'course', _float),
+    (5, 'speed', _float)
+)
+
+GSA_FIELDS = (
+    (2, 'fix_type', _int),
+    (3, 'satellites_used', _used),
+    (15, 'pdop', _float),
+    (16, 'hdop', _float),
+    (17, 'vdop', _float)
+)
+
+GSV_FIELDS = (
+    (3, 'satellites_in_view', _inview),
+)
 
 class GPS(object):
 
     """GPS NMEA Sentence Parser. Creates object that stores all relevant GPS data and statistics.
-    Parses sentences one character at a time using update(). """
-
-        # Max Number of Characters a valid sentence can be (based on GGA sentence)
-    
+    Parses whole buffers of UART bytes using parsesentence(). """
 
     def __init__(self, local_offset=0):
         """Setup GPS Object Status Flags, Internal Data Registers, etc"""
 
         #####################
         # Object Status Flags
-        self.sentence_active = False
-        self.active_segment = 0
-        self.process_crc = False
         self.gps_segments = []
-        self.crc_xor = 0
-        self.char_count = 0
-        self.fix_time = 0
+        self.fix_time = 0  # ticks_ms of the last fix
+        self.fixes = 0  # counts the fixes, a consumer compares it to see a new fix
+        self.fix_timestamp = None  # UTC timestamp of the last fix, RMC, GGA and GLL of one epoch are one fix
 
         #####################
         # Sentence Statistics
         self.crc_fails = 0
         self.clean_sentences = 0
         self.parsed_sentences = 0
+        self.sentence_counts = {}  # sentence id, eg. GNRMC -> clean parses
 
         #####################
         # Data From Sentences
@@ -41,275 +147,232 @@ class GPS(object):
         # Position/Motion
         self.positionvalid = False
         self.timestamp = (0, 0, 0)
-        self.latitude = 0
-        self.longitude = 0
-        self.latitude_string = ''
-        self.longitude_string = ''
+        self.latitude = 0  # micro degrees
+        self.longitude = 0  # micro degrees
         self.position = (0,0)
-        self.speed = 0.0  #meters per second
+        self.speed = 0.0  #knots
         self.course = 0.0 #degrees
-
-        # Pathfinding
-        self.waypoints = [(49.69395, 10.82761)]
-
-        # UART readall
-        self.oldstring = bytes()
+        self.altitude = 0.0  #meters
+
+        # Fix Quality
+        self.fix_quality = 0  # GGA, 0 invalid, 1 GPS, 2 DGPS, 4 RTK fixed, 5 RTK float
+        self.fix_type = 1  # GSA, 1 no fix, 2 2D, 3 3D
+        self.satellites_in_use = 0
+        self.satellites_used = 0
+        self.satellites_in_view = {}  # talker -> satellites in view
+        self.hdop = 0.0  # horizontal dilution of precision, lower is better, for weighting the fusion
+        self.pdop = 0.0
+        self.vdop = 0.0
+
+        # Pathfinding, positions in micro degrees
+        self.waypoints = [(49693950, 10827610)]
+        self.reference = None  # origin of the local tangent plane
+        self.refcos = COS_SCALE  # integer cosine of the reference latitude
+
+        # UART bytes of a partial sentence, completed by the next buffer
+        self.rxbuffer = b''
         
     ########################################
     # Sentence Parsers
     ########################################
-    
-    def gpgll(self):
-        """Parse Geographic Latitude and Longitude (GLL)Sentence. Updates UTC timestamp, latitude,
-        longitude, and fix status"""
 
-        # UTC Timestamp
+    def decode(self, fields):
+        """Decodes the segments of the sentence by a table of (index, attribute, decoder).
+        The attributes are only assigned when every field decodes, an empty field keeps the last value"""
         try:
-            utc_string = self.gps_segments[5]
-
-            if utc_string:  # Possible timestamp found
-                hours = int(utc_string[0:2]) + self.local_offset
-                minutes = int(utc_string[2:4])
-                seconds = float(utc_string[4:])
-                self.timestamp = (hours, minutes, seconds)
-
-            else:  # No Time stamp yet
-                self.timestamp = (0, 0, 0)
-
-        except ValueError:  # Bad Timestamp value present
+            values = [decoder(self, self.gps_segments, index) for index, attribute, decoder in fields]
+        except (ValueError, IndexError):
             return False
 
-        # Check Receiver Data Valid Flag
-        if self.gps_segments[6] == 'A':  # Data from Receiver is Valid/Has Fix
-
-            # Longitude / Latitude
-            try:
-                # Latitude
-                l_string = self.gps_segments[1]
-                lat_degs = l_string[0:2]
-                lat_mins = l_string[2:]
-                lat_hemi = self.gps_segments[2]
-                
-                # Longitude
-                l_string = self.gps_segments[3]
-                lon_degs = l_string[0:3]
-                lon_mins = l_string[3:]
-                lon_hemi = self.gps_segments[4]
-
-                if lat_hemi not in __HEMISPHERES:
-                    raise ValueError()
-
-                if lon_hemi not in __HEMISPHERES:
-                    raise ValueError()                    
-
-                self.latitude, self.latitude_string = self.convert_dm_dd(lat_degs, lat_mins, lat_hemi)
-                self.longitude, self.longitude_string = self.convert_dm_dd(lon_degs, lon_mins, lon_hemi)  
-                self.position = (self.latitude, self.longitude)
-
-            except ValueError:
-                return False
-
-            self.positionvalid = True
-
-            # Update Last Fix Time
-            self.new_fix_time()
+        for i in range(len(fields)):
+            if values[i] is not None:
+                setattr(self, fields[i][1], values[i])
+        return True
 
+    def fixed(self):
+        """Updates the position after a sentence with a fix status"""
+        if self.positionvalid:
+            self.position = (self.latitude, self.longitude)
+            # Update Last Fix Time, once per epoch
+            if self.timestamp != self.fix_timestamp:
+                self.fix_timestamp = self.timestamp
+                self.new_fix_time()
         else:  # Clear Position Data if Sentence is 'Invalid'
             self.latitude = 0
-            self.latitude_string = '0'
             self.longitude = 0
-            self.longitude_string ='0'
             self.position = (0,0)
+        return True
 
-            self.positionvalid = False
+    def gprmc(self):
+        """Parse Recommended Minimum (RMC) Sentence. Updates UTC timestamp, date, latitude, longitude,
+        speed, course and fix status"""
+        return self.decode(RMC_FIELDS) and self.fixed()
 
-        return True
+    def gpgga(self):
+        """Parse Fix Data (GGA) Sentence. Updates UTC timestamp, latitude, longitude, fix quality,
+        satellites in use, HDOP and altitude"""
+        return self.decode(GGA_FIELDS) and self.fixed()
+
+    def gpgll(self):
+        """Parse Geographic Latitude and Longitude (GLL)Sentence. Updates UTC timestamp, latitude,
+        longitude, and fix status"""
+        return self.decode(GLL_FIELDS) and self.fixed()
 
     def gpvtg(self):
         """Parse Track Made Good and Ground Speed (VTG) Sentence. Updates speed and course"""
-        try:
-            course = float(self.gps_segments[1])
-            spd_knt = float(self.gps_segments[5])
-        except ValueError:
-            return False
+        return self.decode(VTG_FIELDS)
 
-        # Include mph and km/h
-        self.speed = spd_knt
-        self.course = course
-        return True
+    def gpgsa(self):
+        """Parse DOP and Active Satellites (GSA) Sentence. Updates fix type, satellites used and DOPs"""
+        return self.decode(GSA_FIELDS)
+
+    def gpgsv(self):
+        """Parse Satellites in View (GSV) Sentence. Updates the satellites in view per talker"""
+        return self.decode(GSV_FIELDS)
 
     ##########################################
     # Data Stream Handler Functions
     ##########################################
 
-    def new_sentence(self):
-        """Adjust Object Flags in Preparation for a New Sentence"""
-        self.gps_segments = ['']
-        self.active_segment = 0
-        self.crc_xor = 0
-        self.sentence_active = True
-        self.process_crc = True
-        self.char_count = 0
-
-    def parsesentence(self, string):
-        idx = 0        
-        string_tmp = self.oldstring + string
-        
-        for c in string_tmp:            
-            idx = idx + 1
-            stat = self.update(chr(c))                        
-            if(stat != None):                                                
-                self.oldstring = string_tmp[idx:]
-                return stat
-            
-    def stringclean(self):
-        self.oldstring = bytes()        
-
-    def update(self, new_char):
-        """Process a new input char and updates GPS object if necessary based on special characters ('$', ',', '*')
-        Function builds a list of received string that are validate by CRC prior to parsing by the  appropriate
-        sentence function. Returns sentence type on successful parse, None otherwise"""
-
-        valid_sentence = False
-
-        # Validate new_char is a printable char        
-        ascii_char = ord(new_char)
-
-        if 10 <= ascii_char <= 126:
-            self.char_count += 1
-
-            # Check if a new string is starting ($)
-            if new_char == '$':
-                self.new_sentence()
+    def parsesentence(self, data):
+        """Parses all complete sentences in a buffer of UART bytes, a partial sentence at the end
+        is kept for the next call. Returns the list of the sentence types parsed"""
+        if len(self.rxbuffer):  # continue the partial sentence of the last call
+            data = self.rxbuffer + data  # bytes, the bytearray of micropython has no find
+
+        parsed = []
+        view = memoryview(data)
+        end = len(data)
+        start = data.find(b'$')
+
+        while start >= 0:
+            star = data.find(b'*', start + 1, start + MAX_SENTENCE)
+            if star < 0:
+                if end - start < MAX_SENTENCE:
+                    break  # the rest of the sentence is still to come
+                start = data.find(b'$', start + 1)  # garbage, no end in sight
+                continue
+
+            if star + 3 > end:
+                break  # the checksum is still to come
+
+            restart = data.find(b'$', start + 1, star)
+            if restart >= 0:  # a sentence cut short, the next one starts within
+                start = restart
+                continue
+
+            sentence = self.parseframe(view, start, star)
+            if sentence:
+                parsed.append(sentence)
+            start = data.find(b'$', star + 3)
+
+        # keep the partial sentence as bytes, so it is searchable on micropython
+        self.rxbuffer = b'' if start < 0 else bytes(view[start:])
+        return parsed
+
+    def parseframe(self, view, start, star):
+        """Checks the XOR checksum of the sentence from $ at start to * at star, and parses it
+        if it is a supported sentence. Returns the sentence type on a clean parse, None otherwise"""
+        crc = 0
+        for c in view[start + 1:star]:
+            crc ^= c
+
+        try:
+            if crc != int(str(bytes(view[star + 1:star + 3]), 'ascii'), 16):
+                self.crc_fails += 1
                 return None
+        except ValueError:  # CRC Value was deformed and could not have been correct
+            self.crc_fails += 1
+            return None
+
+        self.clean_sentences += 1
 
-            elif self.sentence_active:
-
-                # Check if sentence is ending (*)
-                if new_char == '*':
-                    self.process_crc = False
-                    self.active_segment += 1
-                    self.gps_segments.append('')
-                    return None
-
-                # Check if a section is ended (,), Create a new substring to feed
-                # characters to
-                elif new_char == ',':
-                    self.active_segment += 1
-                    self.gps_segments.append('')
-
-                # Store All Other printable character and check CRC when ready
-                else:
-                    self.gps_segments[self.active_segment] += new_char
-
-                    # When CRC input is disabled, sentence is nearly complete
-                    if not self.process_crc:
-
-                        if len(self.gps_segments[self.active_segment]) == 2:
-                            try:
-                                final_crc = int(self.gps_segments[self.active_segment], 16)
-                                if self.crc_xor == final_crc:
-                                    valid_sentence = True
-                                else:
-                                    self.crc_fails += 1
-                            except ValueError:
-                                pass  # CRC Value was deformed and could not have been correct
-
-                # Update CRC
-                if self.process_crc:
-                    self.crc_xor ^= ascii_char
-
-                # If a Valid Sentence Was received and it's a supported sentence, then parse it!!
-                if valid_sentence:
-                    self.clean_sentences += 1  # Increment clean sentences received
-                    self.sentence_active = False  # Clear Active Processing Flag
-
-                    if self.gps_segments[0][2:] in self.supported_sentences:
-                        # parse the Sentence Based on the message type, return True if parse is clean                        
-                        if self.supported_sentences[self.gps_segments[0][2:]](self):                        
-                            # Let host know that the GPS object was updated by returning parsed sentence type
-                            self.parsed_sentences += 1
-                            return self.gps_segments[0]
-
-                # Check that the sentence buffer isn't filling up with Garage waiting for the sentence to complete
-                if self.char_count > 76:
-                    self.sentence_active = False
-
-        # Tell Host no new sentence was parsed
+        try:
+            # the fields are only split for supported sentences, after the 2 character talker id
+            if (str(bytes(view[start + 3:start + 6]), 'ascii') in self.supported_sentences) == False:
+                return None
+            self.gps_segments = str(bytes(view[start + 1:star]), 'ascii').split(',')
+        except ValueError:  # not ascii
+            return None
+
+        # parse the Sentence Based on the message type, return True if parse is clean
+        if self.supported_sentences[self.gps_segments[0][2:]](self):
+            self.parsed_sentences += 1
+            sentence = self.gps_segments[0]
+            self.sentence_counts[sentence] = self.sentence_counts.get(sentence, 0) + 1
+            return sentence
         return None
 
     def new_fix_time(self):
-        """Updates a high resolution counter with current time when fix is updated. Currently only triggered from
-        GGA, GSA and RMC sentences"""
-        self.fix_time = time.time()
+        """Updates a high resolution counter with current time when fix is updated. Triggered from
+        RMC, GGA and GLL sentences with a valid fix"""
+        self.fix_time = ticks_ms()
+        self.fixes += 1
         return self.fix_time
 
 
 
-    def distance(self,p1:tuple,p2:tuple) -> int:    
+    def setreference(self, p:tuple):
+        """
+        sets the origin of the local tangent plane, a position near the area of operation
+        p = (lat_e6, lon_e6) micro degrees
+        """
+        self.reference = p
+        self.refcos = int(cos(radians(p[0] / 1000000)) * COS_SCALE)
+
+    def offset(self, p:tuple) -> tuple:
+        """
+        integer offset of a position from the reference, the first position offset when none is set
+        p = (lat_e6, lon_e6) micro degrees
+        returns (east, north) in centimetres
+        """
+        if self.reference is None:
+            self.setreference(p)
+
+        north = (p[0] - self.reference[0]) * CM_PER_MICRODEGREE_E3 // 1000
+        east = (p[1] - self.reference[1]) * CM_PER_MICRODEGREE_E3 // 1000 * self.refcos // COS_SCALE
+        return (east, north)
+
+    def distance(self,p1:tuple,p2:tuple) -> float:
         """
         distance in meters between 2 position
-        p1 = lat_dd,lon_dd degree decimal format
-        p2 = lat_dd,lon_dd degree decimal format
-        returns int distans in meters
+        p1 = (lat_e6, lon_e6) micro degrees
+        p2 = (lat_e6, lon_e6) micro degrees
+        returns distance in meters, from the integer centimetre offsets
         """
-        
-        R = 6373000        # Radius of the earth in m
-        
-        lat1_dd, lon1_dd = p1
-        lat1_dd, long1_dd = radians(lat1_dd), radians(lon1_dd)
+        east1, north1 = self.offset(p1)
+        east2, north2 = self.offset(p2)
 
-        lat2_dd, lon2_dd = p2
-        lat2_dd, lon2_dd = radians(lat2_dd), radians(lon2_dd)
-        
-        deltaLat = lat2_dd - lat1_dd
-        deltaLon = lon2_dd - long1_dd
-        
-        x = deltaLon * cos((lat1_dd+lat2_dd)/2)
-        distance = sqrt(x**2 + deltaLat**2) * R
-        
-        return distance
+        east, north = east2 - east1, north2 - north1
+        return sqrt(east * east + north * north) / 100
 
-    def bearing(self, p1:tuple, p2:tuple) -> int:
+    def bearing(self, p1:tuple, p2:tuple) -> float:
         """
         provides a bearing between two positions
-        p1 = (lat_dd, lon_dd) degree decimal format
-        p2 = (lat_dd, lon_dd) degree decimal format
+        p1 = (lat_e6, lon_e6) micro degrees
+        p2 = (lat_e6, lon_e6) micro degrees
+        returns degrees from north, clockwise
         """
-        lat1_dd, lon1_dd = p1
-        lat1_dd, lon1_dd = radians(lat1_dd), radians(lon1_dd)
+        east1, north1 = self.offset(p1)
+        east2, north2 = self.offset(p2)
 
-        lat2_dd, lon2_dd = p2
-        lat2_dd, lon2_dd = radians(lat2_dd), radians(lon2_dd)
-        
-        deltaLon = lon2_dd - lon1_dd
-        
-        y = sin(deltaLon) * cos(lat2_dd)
-        x = cos(lat1_dd) * sin(lat2_dd) - sin(lat1_dd) * cos(lat2_dd) * cos(deltaLon)
-        
-        bearing = (degrees(atan2(y, x)) + 360) % 360
+        bearing = (degrees(atan2(east2 - east1, north2 - north1)) + 360) % 360
         return bearing
 
-    def convert_dm_dd(self, degree :str,minutes :str, hemi :str) -> tuple:
-        """ 
-        convert degree minutes format to degrees decimal format 
-        eg 49 21.3454 S -> dd = -49.3557566
-        returns float and string representations of degree decimal
-        ISSUE# On small mcu's the float precision is low:
-            eg. '49.3557566' -> 49.35575 
-            this can cause the robot hunt or occilate around a waypoint
+    def convert_dm_e6(self, degree :str, minutes :str, hemi :str) -> int:
         """
-        degree = int(degree)
-        minuite, minuite_decimal = minutes.split('.')
-        degree_decimal  = int(minuite + minuite_decimal) // 6
-
-        if hemi in ['S','W']:
-            degree=degree * -1
+        convert degree minutes format to integer micro degrees, from the digits without a float
+        eg 49 21.3454 S -> -49355757
+        the minutes are taken to 5 decimals, 1e-5 minutes is 1/6 micro degree
+        """
+        whole, fraction = minutes.split('.') if '.' in minutes else (minutes, '')
+        minutes_e5 = int(whole) * 100000 + int((fraction + '00000')[:5])
+        value = int(degree) * 1000000 + (minutes_e5 + 3) // 6  # rounded
 
-        dd_str = str(degree)+'.'+str(degree_decimal)
-        dd_float = float(dd_str)
+        if hemi in ('S','W'):
+            value = -value
 
-        return (dd_float, dd_str)
+        return value
 
-    # The supported NMEA sentences    
-    supported_sentences = { 'VTG': gpvtg,  'GLL': gpgll } # GPS + GLONASS
\ No newline at end of file
+    # The supported NMEA sentences, for any talker, GP GPS, GL GLONASS, GA Galileo, GN multi system
+    supported_sentences = { 'RMC': gprmc, 'GGA': gpgga, 'GSA': gpgsa, 'GSV': gpgsv, 'VTG': gpvtg, 'GLL': gpgll }
\ No newline at end of file
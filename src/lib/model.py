@@ -1,4 +1,6 @@
 from lib.reactor import updatemodel
+from lib.bencode import Encoded, bencode
+from lib.wireformat import compactvalue
 class Model():
 
     # Constructor
@@ -12,6 +14,11 @@ class Model():
         self.meta = {}
         self.props = {}
         self.ev = {}
+        self.version = 0  # bumped on every change of a prop or the wires
+        self.versions = {}  # prop -> version of its last change
+        self.wiresversion = 0  # version of the last change of the wires
+        self.encoded = None  # cached toEncoded, cleared on every change
+        self.compacted = None  # cached compact toEncoded, cleared on every change
 
     # Event
     # on - adds an event callback
@@ -36,6 +43,30 @@ class Model():
         updatemodel(self.nodeid,self.nodeid,'updatemodel',self.id, prop, value)
         
         
+    # Version
+    # bump - counts a change, of a prop or of the wires when prop is None
+    # @param prop String the changed prop
+    def bump(self, prop=None):
+        self.version += 1
+        self.encoded = None
+        self.compacted = None
+        if prop is None:
+            self.wiresversion = self.version
+        else:
+            self.versions[prop] = self.version
+
+    # toPatch - the props and wires changed after a version
+    # @param since Int the version held by a shadow
+    def toPatch(self, since):
+        props = {}
+        for prop in self.versions:
+            if self.versions[prop] > since:
+                props[prop] = self.props[prop]
+        patch = {'version': self.version, 'props': props}
+        if self.wiresversion > since:
+            patch['wires'] = self.wires
+        return patch
+
     # lifecycle start method
     def start(self):
         pass
@@ -44,6 +75,17 @@ class Model():
     def stop(self):
         pass
 
+    # toEncoded - the bencoded toDict, encoded once per version
+    # @param compact Boolean with the interned keys of the compact wire encoding
+    def toEncoded(self, compact=False):
+        if compact:
+            if self.compacted is None:
+                self.compacted = Encoded(bencode(compactvalue(self.toDict())))
+            return self.compacted
+        if self.encoded is None:
+            self.encoded = Encoded(bencode(self.toDict()))
+        return self.encoded
+
     # TODO is this for serialization ?
     def toDict(self):
         return {
@@ -54,5 +96,6 @@ class Model():
             # 'eventlisteners' : self.eventlisteners,
             'wires': self.wires,
             'meta': self.meta,
-            'props': self.props
+            'props': self.props,
+            'version': self.version
         }
@@ -1,48 +1,208 @@
 from config import nodekey
 from lib.typecoersion import coerce
 from lib.bencode import bdecode, bencode
+from lib.clock import ticks_ms, ticks_diff
 from lib.store import Store
+from lib.ringbuffer import RingBuffer
+from lib.coalescer import Coalescer
+from lib.routingtable import rt
+from lib.reliable import channel
+from lib.fragment import reassembler
+from lib import wireformat
+
+
+def coalescekey(packet):
+    """the key under which a newer packet supersedes an older one, None if it never does.
+    Property updates are keyed per (destination, modelid, prop), an updatemodels has several
+    targets so it has no key, the coalescer holds it per target"""
+    command = packet[2]
+    if command == 'updatemodel':
+        return (packet[1], packet[3], packet[4])
+    if command == 'updateshadowmodel':
+        return (packet[1], command, packet[3], packet[4], packet[5])
+    return None
+
 
 store = Store()  # get singleton of store
-sendqueue = []
-receivequeue = []
+# bounded queues, under load older property updates are coalesced, else the oldest packet is dropped,
+# received reliable commands are acked so they are never dropped
+sendqueue = RingBuffer(64, 'coalesce', coalescekey)
+receivequeue = RingBuffer(64, 'coalesce', coalescekey, channel.wants)
+# property updates to other nodes are held back, only the latest per (destination, model, prop) is sent
+coalescer = Coalescer(coalescekey, 100)
+resyncinterval = 2000  # ms between delta resync requests to a shadowed node
+renegotiateinterval = 2000  # ms between negotiations asked for compact packets from unknown peers
+renegotiated = None  # ticks_ms of the last negotiation asked for
 reactions = {}
 
 
+def idle():
+    pass
+
+
+onreceive = idle  # called when a packet is queued to be reacted upon, e.g. to wake the react task
+onsend = idle  # called when a packet is queued to be sent, e.g. to wake the send task
+loopbackfidelity = False  # debug: round trip self addressed packets through bencode, as on the wire
+
+
 def send(*packet):
     #print(packet)
     """sends commands to a node"""
     if nodekey == packet[1]:  # is packet for me
-        receive(bdecode(bencode(packet)))
+        if loopbackfidelity:
+            receive(bdecode(bencode(packet)))
+        else:
+            # the packet tuple is a shallow copy, the dicts and lists in it are copied, so the
+            # receiver does not alias live state, e.g. a shadow of model.props
+            receive(tuple(copyvalue(x) for x in packet))
     else:
-        sendqueue.append(packet)
+        if not coalesce(packet):
+            sendqueue.append(stamp(packet))
+        onsend()
+
+
+def copyvalue(x):
+    """a deep copy of the dicts and lists of a value, other values are immutable and shared"""
+    if type(x) == dict:
+        return {k: copyvalue(v) for k, v in x.items()}
+    if type(x) == list or type(x) == tuple:
+        return [copyvalue(v) for v in x]
+    return x
+
+
+def coalesce(packet):
+    """holds back a property update, returns False if it is not to be coalesced.
+    An updatemodels is held as one updatemodel per target, so every target has one key.
+    A packet without a salt is held without one, None does not encode"""
+    if packet[2] != 'updatemodels':
+        return coalescer.put(packet)
+
+    fro, to, command, targets, value = packet[:5]
+    salt = tuple(packet[5:6])  # the salt, if any
+    for modelid, prop in targets:
+        if not coalescer.put((fro, to, 'updatemodel', modelid, prop, value) + salt):
+            return False  # not coalesced for this destination, the first target tells
+    return True
+
+
+def flush(force=False):
+    """moves the coalesced packets that are due to the sendqueue, returns the number moved"""
+    due = []
+    coalescer.flush(due, force=force)
+    due = regroup(due)
+    for packet in due:
+        sendqueue.append(stamp(packet))
+    return len(due)
+
+
+def stamp(packet):
+    """adds the version of the previous update of the prop sent to the listener to an updateshadowmodel,
+    as it leaves the coalescer, so the listener tells a lost update from updates superseded by coalescing"""
+    if packet[2] != 'updateshadowmodel' or len(packet) != 8:
+        return packet
+    key = (packet[1], packet[4], packet[5])  # listener, modelid, prop
+    previous = store.shadowsent.get(key, 0)
+    store.shadowsent[key] = packet[7]
+    return tuple(packet) + (previous,)
+
+
+def regroup(packets):
+    """joins the updatemodel packets to a node with the same value and salt into one updatemodels"""
+    groups = []  # [packet, targets]
+    for packet in packets:
+        if packet[2] == 'updatemodel':
+            salt = tuple(packet[6:7])  # the salt, if any
+            for group in groups:
+                first = group[0]
+                if group[1] is not None and first[1] == packet[1] and type(first[5]) == type(packet[5]) \
+                        and first[5] == packet[5] and tuple(first[6:7]) == salt:
+                    group[1].append((packet[3], packet[4]))
+                    break
+            else:
+                groups.append([packet, [(packet[3], packet[4])]])
+        else:
+            groups.append([packet, None])
+
+    grouped = []
+    for packet, targets in groups:
+        if targets is None or len(targets) == 1:
+            grouped.append(packet)
+        else:
+            grouped.append((packet[0], packet[1], 'updatemodels', tuple(targets), packet[5])
+                           + tuple(packet[6:7]))
+    return grouped
 
 
 def receive(packet):
-    """recives and queue's commands to be reacted apon"""
+    """recives and queue's commands to be reacted apon, returns False if there was no room"""
     #print('receivequeue append', packet)
-    receivequeue.append(packet)
+    queued = receivequeue.append(packet)
+    onreceive()
+    return queued
+
 
+def accepts(packet):
+    """is the packet for me or a multicast, and a known reaction"""
+    return packet[1] in [nodekey, 0] and packet[2] in reactions
 
-def react():
-    """ processed the commands in the receivequeue as a task in the asyncio loop"""
+
+def react(maxpackets=None, maxms=None):
+    """ processes the commands in the receivequeue as a task in the asyncio loop
+    @maxpackets Int: optional budget of packets per call
+    @maxms Int: optional budget of milliseconds per call, so the loop gets a turn
+    @returns: the number of packets taken from the receivequeue
+    """
     #print('processing {} items in receivequeue'.format(len(receivequeue)))
+    processed = 0
+    if maxms is not None:
+        start = ticks_ms()
+
     while len(receivequeue):
 
-        packet = receivequeue.pop(0)
+        if maxpackets is not None and processed >= maxpackets:
+            break  # packet budget spent, the rest waits for the next call
+        if maxms is not None and ticks_diff(ticks_ms(), start) >= maxms:
+            break  # time budget spent
+
+        packet = receivequeue.popleft()
+        processed += 1
         
-        if not packet[1] in [nodekey, 0]:
-            return  # not for me and not a multicast
-        if not packet[2] in reactions:
-            return  # not a known reaction
+        if not accepts(packet):
+            continue  # not for me and not a multicast, or not a known reaction
 
         #print('react function', reactions[packet[2]])
         reactions[packet[2]](*packet)
 
+    return processed
+
 
 def announce(fro, to, command):
     """ announces a product descritption"""
     send(nodekey, fro or 0, 'adddescription', store.models['1'].toDescription())
+    if wireformat.enabled:  # offer the compact wire encoding
+        send(nodekey, fro or 0, 'negotiate', wireformat.version, True)
+
+
+def negotiate(fro, to, command, peerversion, reply=False):
+    """ registers a peer that accepts the compact wire encoding, replies with our version if asked"""
+    if not fro or fro == nodekey:
+        return  # not from a peer
+    if wireformat.acceptpeer(fro, peerversion) and reply:
+        send(nodekey, fro, 'negotiate', wireformat.version, False)
+
+
+def renegotiate():
+    """asks all peers to negotiate again, at most once per renegotiateinterval. A compact packet from
+    an unknown short id is from a peer that negotiated with a previous boot of this node, the sender
+    is unknown so the request is a multicast"""
+    global renegotiated
+    if not wireformat.enabled:
+        return
+    now = ticks_ms()
+    if renegotiated is not None and ticks_diff(now, renegotiated) < renegotiateinterval:
+        return  # asked recently
+    renegotiated = now
+    send(nodekey, 0, 'negotiate', wireformat.version, True)
 
 
 def updatemodel(fro, to, command, modelid, prop, value, salt=None):
@@ -50,6 +210,8 @@ def updatemodel(fro, to, command, modelid, prop, value, salt=None):
 
     # TODO still needed ?
     if not to == nodekey:
+        if salt is None:
+            return send(nodekey, to, command, modelid, prop, value)
         return send(nodekey, to, command, modelid, prop, value, salt)
 
     if (modelid in store.models) == False:
@@ -73,6 +235,8 @@ def updatemodel(fro, to, command, modelid, prop, value, salt=None):
         return  # no change to the value
 
     model.props[prop] = coercedvalue  # assigns the new value
+    model.bump(prop)
+    store.changed()
 
     # emit a property value change event
     model.emit(prop, model, prop, model.props[prop])
@@ -80,17 +244,23 @@ def updatemodel(fro, to, command, modelid, prop, value, salt=None):
     # propagate to shadow models
     for shadownodeid in store.shadowlisteners:
         send(nodekey, shadownodeid, 'updateshadowmodel',
-             model.nodeid, model.id, prop, coercedvalue)
+             model.nodeid, model.id, prop, coercedvalue, model.version)
 
-    if (prop in model.wires) == False:
+    if ((modelid, prop) in store.wireindex) == False:
         return  # any wire listeners for prop
 
-    wirelisteners = model.wires[prop]
-    # propagate the value to the wire listeners
-    for listeneruri in wirelisteners:
-        listenernodeid, listnermodlid, listenerprop = tuple(
-            listeneruri.split('/'))
-        send(nodekey, listenernodeid, 'updatemodel', listnermodlid, listenerprop, coercedvalue, salt)
+    # propagate the value to the wire listeners, one packet per listener node
+    for listenernodeid, targets in store.wireindex[(modelid, prop)]:
+        if len(targets) == 1:
+            send(nodekey, listenernodeid, 'updatemodel', targets[0][0], targets[0][1], coercedvalue, salt)
+        else:
+            send(nodekey, listenernodeid, 'updatemodels', targets, coercedvalue, salt)
+
+
+def updatemodels(fro, to, command, targets, value, salt=None):
+    """ updates a property value of several models of this node, targets is a list of (modelid, prop) """
+    for modelid, prop in targets:
+        updatemodel(fro, to, 'updatemodel', modelid, prop, value, salt)
 
 
 def addwirelistener(fro, to, command, producer, consumer):
@@ -113,9 +283,13 @@ def addwirelistener(fro, to, command, producer, consumer):
     if (pprop in model.wires) == True:
         model.wires[pprop][consumer] = ''
 
+    store.indexwires(model, pprop)
+    model.bump()
+    store.changed()
+
     for shadowlistenerid in store.shadowlisteners:  # propagate to shadow listeners
         send(nodekey, shadowlistenerid,
-             'shadowaddwirelistener', producer, consumer)
+             'shadowaddwirelistener', producer, consumer, model.version)
 
     #print('proagate {} to the wirelistener {}'.format(model.props[pprop],consumer))
     send(nodekey, cnodeid, 'updatemodel', cmodelid, cprop, model.props[pprop])
@@ -144,23 +318,54 @@ def removewirelistener(fro, to, command, producer, consumer):
         if (consumer in model.wires[pprop]) == True:
             del model.wires[pprop][consumer]
 
+    store.indexwires(model, pprop)
+    model.bump()
+    store.changed()
+
     for shadowlistenerid in store.shadowlisteners:  # propagate to shadow listeners
         send(nodekey, shadowlistenerid,
-             'shadowremovewirelistener', producer, consumer)
+             'shadowremovewirelistener', producer, consumer, model.version)
 
     # save the store state to non-volatile memory, so the wire state is remembered
     store.serialize()
 
 
+def snapshot(model, to):
+    """the state of a model to send, the cached encoding for other nodes, with interned keys
+    for negotiated peers, a dictionary for this node as self addressed packets are not encoded"""
+    if to == nodekey:
+        return model.toDict()
+    return model.toEncoded(wireformat.compactable((nodekey, to, 'addshadow')))
+
+
 def addshadowlistener(fro, to, command, listenernodeid):
     """request to a remote node, so add self as a shadow listener"""
     # register the shadow listener
     store.shadowlisteners[listenernodeid] = True
     models = {}
     for modelid in store.models:
-        models[modelid] = (store.models[modelid]).toDict()
+        models[modelid] = snapshot(store.models[modelid], listenernodeid)
     # notify the listener the current models
-    send(nodekey, listenernodeid, 'addshadow', models)
+    send(nodekey, listenernodeid, 'addshadow', models, store.epoch)
+
+
+def resyncshadow(fro, to, command, listenernodeid, epoch, versions):
+    """request to a remote node, to resend what changed since the versions a shadow listener holds"""
+    if epoch != store.epoch:
+        return addshadowlistener(fro, to, command, listenernodeid)  # versions of a previous boot, resend all
+
+    store.shadowlisteners[listenernodeid] = True
+    models = {}
+    for modelid in store.models:
+        model = store.models[modelid]
+        if (modelid in versions) == False:
+            models[modelid] = snapshot(model, listenernodeid)  # a model added since
+        elif versions[modelid] < model.version:
+            models[modelid] = model.toPatch(versions[modelid])
+
+    removed = [modelid for modelid in versions if (modelid in store.models) == False]
+    # notify the listener the changes only
+    send(nodekey, listenernodeid, 'patchshadow', store.epoch, models, removed)
 
 
 def removeshadowlistener(fro, to, command, listenernodeid):
@@ -168,10 +373,22 @@ def removeshadowlistener(fro, to, command, listenernodeid):
     if listenernodeid in store.shadowlisteners:
         # unregister the shadow listener
         del store.shadowlisteners[listenernodeid]
+        for key in [key for key in store.shadowsent if key[0] == listenernodeid]:
+            del store.shadowsent[key]
         # notify the listener the current models
         send(nodekey, listenernodeid, 'removeshadow')
 
 
+def routes(fro, to, command):
+    """ answers with the routing table, queue and delivery statistics of this node, for inspection"""
+    table = rt.stats()
+    table['reliable'] = channel.stats()
+    table['fragments'] = reassembler.stats()
+    table['sendqueue'] = sendqueue.stats()
+    table['receivequeue'] = receivequeue.stats()
+    send(nodekey, fro, 'addroutes', table)
+
+
 def addbrick(fro, to, command, packagename):
     """creats an instance of a brick"""
     #plugin = importlib.import_module('plugins.'+str(packagename), '.')
@@ -192,10 +409,17 @@ def addmodel(model):
 
     store.models[model.id] = model
 
+    if (model.id in store.savedwires) == True:  # restore the saved wires
+        model.wires = store.savedwires[model.id]
+    store.indexwires(model)
+    model.encoded = None  # id, nodeid and wires are assigned
+    model.compacted = None
+    store.changed()
+
     model.start()  # lifecycle start
 
     for shadowlistenerid in store.shadowlisteners:  # propagate to shadow listeners
-        send(nodekey, shadowlistenerid, 'shadowaddmodel', model.toDict())
+        send(nodekey, shadowlistenerid, 'shadowaddmodel', snapshot(model, shadowlistenerid))
 
 
 def removemodel(fro, to, command, modelid):
@@ -209,6 +433,8 @@ def removemodel(fro, to, command, modelid):
         send(nodekey, shadowlistenerid,'shadowremovemodel', model.id)
 
     del store.models[modelid]
+    store.unindexwires(modelid)
+    store.changed()
 
 
 """ from here on master node only """
@@ -220,21 +446,107 @@ def adddescription(fro, to, command, description):
     store.emit('adddescription', description, fro)
 
 
-def addshadow(fro, to, command, shadow):
+def addroutes(fro, to, command, table):
+    """add the routing table of a node, emits an event"""
+    store.routes[fro] = table
+    store.emit('addroutes', table, fro)
+
+
+def requestresync(nodeid, force=False):
+    """asks a shadowed node for the changes since the versions held, at most once per resyncinterval"""
+    now = ticks_ms()
+    if not force and (nodeid in store.resyncs) and ticks_diff(now, store.resyncs[nodeid]) < resyncinterval:
+        return  # asked recently
+    store.resyncs[nodeid] = now
+
+    if (nodeid in store.shadows) == False or (nodeid in store.shadowepochs) == False:
+        return send(nodekey, nodeid, 'addshadowlistener', nodekey)  # nothing held, ask for all
+
+    shadow = store.shadows[nodeid]
+    versions = {}
+    for modelid in shadow:
+        versions[modelid] = shadow[modelid].get('version', 0)
+    send(nodekey, nodeid, 'resyncshadow', nodekey, store.shadowepochs[nodeid], versions)
+
+
+def shadowversion(nodeid, modelid, shadowmodel, prop, version, previous=None):
+    """tracks the version of a shadow prop, returns False for a stale update.
+    The shadow 'version' is that of the last snapshot or patch, store.shadowversions tracks the
+    updates of the props since, apart from the shadow, so it is not sent to the dashboards.
+    An update names the version of the previous update of the prop sent, if the shadow holds an
+    older one that update was lost and a resync fetches the difference. Updates superseded by
+    coalescing were never sent, so they are no gap"""
+    if version is None or ('version' in shadowmodel) == False:
+        return True  # unversioned
+    if ((nodeid, modelid) in store.shadowversions) == False:
+        store.shadowversions[(nodeid, modelid)] = {}
+    versions = store.shadowversions[(nodeid, modelid)]
+    known = max(versions.get(prop, 0), shadowmodel['version'])
+    if version <= known:
+        return False  # older than the shadow
+    if previous is not None and previous > known:
+        requestresync(nodeid)
+    versions[prop] = version
+    return True
+
+
+def forgetversions(nodeid, modelid=None):
+    """drops the tracked prop versions of the shadow models of a node, or of one model,
+    when a whole model replaces them or the shadow is removed"""
+    for key in [key for key in store.shadowversions if key[0] == nodeid and (modelid is None or key[1] == modelid)]:
+        del store.shadowversions[key]
+
+
+def addshadow(fro, to, command, shadow, epoch=None):
     """adds a shadow of a node, emits an event"""
     store.shadows[fro] = shadow          # register the shadowin shadows
+    forgetversions(fro)
+    if epoch is not None:
+        store.shadowepochs[fro] = epoch
     # shadow emits a shadow and shadows
     store.emit('addshadow', shadow, store.shadows)
  
 
+def patchshadow(fro, to, command, epoch, models, removed):
+    """applies the changes since a resync to the shadow of a node, emits an event"""
+    if (fro in store.shadows) == False:
+        return  # no such shadow
+    shadow = store.shadows[fro]
+    store.shadowepochs[fro] = epoch
+
+    for modelid in models:
+        model = models[modelid]
+        if (modelid in shadow) == False or ('meta' in model) == True:
+            shadow[modelid] = model  # a whole model
+            forgetversions(fro, modelid)
+            continue
+        shadowmodel = shadow[modelid]
+        versions = store.shadowversions.get((fro, modelid), {})
+        for prop in model['props']:
+            if versions.get(prop, 0) > model['version']:
+                continue  # an update newer than the patch arrived first
+            shadowmodel['props'][prop] = model['props'][prop]
+        if ('wires' in model) == True:
+            shadowmodel['wires'] = model['wires']
+        shadowmodel['version'] = model['version']
+
+    for modelid in removed:
+        if (modelid in shadow) == True:
+            del shadow[modelid]
+        forgetversions(fro, modelid)
+
+    store.emit('patchshadow', shadow, store.shadows)
+
+
 def removeshadow(fro, to, command):
     """removes a shadow of a node, emits an event"""
     del store.shadows[fro]  # unregister the shadowin shadows
+    forgetversions(fro)
     # shadow emits a shadow and shadows
     store.emit('removeshadow', fro, store.shadows)
 
 
-def updateshadowmodel(fro, to, command, nodeid, modelid, prop, value):
+def updateshadowmodel(fro, to, command, nodeid, modelid, prop, value, version=None, previous=None):
     """notifies shadow listeners of an model property change"""
     if (nodeid in store.shadows) == False:
         return  # unknown shadow
@@ -243,6 +555,9 @@ def updateshadowmodel(fro, to, command, nodeid, modelid, prop, value):
         return  # unknow shadowmodel
     shadowmodel = shadow[modelid]
 
+    if not shadowversion(nodeid, modelid, shadowmodel, prop, version, previous):
+        return  # stale update
+
     # update the value #TODO Check that the reference structure is correct
     shadowmodel['props'][prop] = value
 
@@ -250,7 +565,7 @@ def updateshadowmodel(fro, to, command, nodeid, modelid, prop, value):
     store.emit('updateshadowmodel', prop, value, shadowmodel)
 
 
-def shadowaddwirelistener(fro, to, command, producer, consumer):
+def shadowaddwirelistener(fro, to, command, producer, consumer, version=None):
     """shadow add wire listener, updates shadow state from orign model state"""
     nodeid, modelid, prop = tuple(producer.split('/'))
 
@@ -278,7 +593,7 @@ def shadowaddwirelistener(fro, to, command, producer, consumer):
     store.emit('shadowaddwire', producer, consumer)
 
 
-def shadowremovewirelistener(fro, to, command, producer, consumer):
+def shadowremovewirelistener(fro, to, command, producer, consumer, version=None):
     """shadow remove wire listener, updates shadow state from orign model state"""
     nodeid, modelid, prop = tuple(producer.split('/'))
 
@@ -317,6 +632,7 @@ def shadowaddmodel(fro, to, command, model):
     shadow = store.shadows[nodeid]
 
     shadow[modelid] = model  # assign the shadowmodel
+    forgetversions(nodeid, modelid)
 
     store.emit('shadowaddmodel', shadow, model)
 
@@ -332,6 +648,7 @@ def shadowremovemodel(fro, to, command, modelid):
         return  # no such shadowmodel
 
     del store.shadows[fro][modelid]  # delete the shadow model
+    forgetversions(fro, modelid)
 
     store.emit('shadowremovemodel', fro, modelid)
 
@@ -339,15 +656,21 @@ def shadowremovemodel(fro, to, command, modelid):
 reactions = {
     'announce': announce,
     'updatemodel': updatemodel,
+    'updatemodels': updatemodels,
     'addwirelistener': addwirelistener,
     'removewirelistener': removewirelistener,
     'addshadowlistener': addshadowlistener,
     'removeshadowlistener': removeshadowlistener,
+    'resyncshadow': resyncshadow,
     'addbrick': addbrick,
     'removemodel': removemodel,
+    'negotiate': negotiate,
+    'routes': routes,
 
     'adddescription': adddescription,
+    'addroutes': addroutes,
     'addshadow': addshadow,
+    'patchshadow': patchshadow,
     'removeshadow': removeshadow,
     'shadowaddmodel': shadowaddmodel,
     'shadowremovemodel': shadowremovemodel,
@@ -0,0 +1,115 @@
+"""
+Records the raw sensor input of a sea trial to a compact binary file,
+so the GPS parser and the course fusion can be replayed on the desk.
+
+A record is a header of kind, ticks_ms and payload length, then the payload
+    UART   the bytes read from the GPS uart
+    GYRO   gyro_z in deg/s and deltaT in s, two floats
+    COMPASS the magnetic heading in degrees, one float
+"""
+from lib.clock import ticks_ms
+
+try: # try to make this work for both python37 and micropython
+    import ustruct as struct
+except ImportError:
+    import struct
+
+MAGIC = b'RBR1' # file format and version
+HEADER = '<BIH' # kind, ticks_ms, payload length
+HEADER_SIZE = struct.calcsize(HEADER)
+
+UART = 1
+GYRO = 2
+COMPASS = 3
+
+
+class Recorder():
+    '''
+    Appends records to a file. Records are buffered and written in blocks
+    of flushbytes, to spare the flash. Once the file holds maxbytes
+    the recording stops and the records are counted as dropped
+    '''
+
+    def __init__(self, filename='record.bin', maxbytes=1048576, flushbytes=4096):
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.maxbytes = maxbytes
+        self.flushbytes = flushbytes
+        self.buffer = bytearray()
+        self.written = len(MAGIC)
+
+        # statistics
+        self.records = 0
+        self.dropped = 0
+
+    def record(self, kind, payload, now=None):
+        now = ticks_ms() if now is None else now
+        if self.file is None or self.written + len(self.buffer) + HEADER_SIZE + len(payload) > self.maxbytes:
+            self.dropped += 1
+            return False
+        self.buffer.extend(struct.pack(HEADER, kind, now & 0xFFFFFFFF, len(payload)))
+        self.buffer.extend(payload)
+        self.records += 1
+        if len(self.buffer) >= self.flushbytes:
+            self.flush()
+        return True
+
+    def uart(self, data, now=None):
+        """records the bytes read from the gps uart"""
+        return self.record(UART, data, now)
+
+    def gyro(self, gyro_z, deltaT, now=None):
+        """records a gyro reading"""
+        return self.record(GYRO, struct.pack('<ff', gyro_z, deltaT), now)
+
+    def compass(self, heading, now=None):
+        """records a magnetic heading"""
+        return self.record(COMPASS, struct.pack('<f', heading), now)
+
+    def flush(self):
+        if self.file is None or not len(self.buffer):
+            return
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.written += len(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {
+            'records': self.records,
+            'bytes': self.written + len(self.buffer),
+            'dropped': self.dropped
+        }
+
+
+def records(data):
+    """
+    Generator, the records of a recording as (kind, ticks, payload).
+    The payload of a UART record is bytes, of the other kinds a tuple of floats.
+    A record cut short at the end, by a reset while recording, is ignored
+    """
+    if data[0:len(MAGIC)] != MAGIC:
+        raise ValueError('not a recording')
+    pos, end = len(MAGIC), len(data)
+    while pos + HEADER_SIZE <= end:
+        kind, ticks, length = struct.unpack_from(HEADER, data, pos)
+        pos += HEADER_SIZE
+        if pos + length > end:
+            return
+        if kind == UART:
+            payload = bytes(data[pos:pos + length])
+        elif kind == GYRO:
+            payload = struct.unpack_from('<ff', data, pos)
+        elif kind == COMPASS:
+            payload = struct.unpack_from('<f', data, pos)
+        else:
+            payload = None # unknown kind, from a newer recorder
+        pos += length
+        if payload is not None:
+            yield (kind, ticks, payload)
@@ -0,0 +1,204 @@
+try:
+    import urandom as random
+except ImportError:
+    import random
+
+from lib.clock import ticks_ms, ticks_diff, ticks_add
+
+# commands that are delivered reliably, property update streams are left out
+commands = (
+    'addwirelistener',
+    'removewirelistener',
+    'addshadowlistener',
+    'removeshadowlistener',
+    'addbrick',
+    'removemodel',
+    'addshadow',
+    'removeshadow',
+    'shadowaddmodel',
+    'shadowremovemodel',
+    'shadowaddwirelistener',
+    'shadowremovewirelistener',
+    'resyncshadow',
+    'patchshadow'
+)
+
+
+class ReliableChannel():
+    '''
+    Sequenced delivery with selective acks, retransmission with
+    exponential backoff and duplicate suppression, per peer.
+
+    A packet (fro, to, command, ...) is sent as the frame
+        (fro, to, 'rel', epoch, seq, command, ...)
+    and acknowledged with
+        (to, fro, 'ack', epoch, base, [seq, ...])
+    where every seq up to base, and the listed ones, were received.
+    The epoch is random per boot, so a restarted peer starts afresh.
+    '''
+
+    def __init__(self, window=64, timeout=250, retries=5):
+        self.window = window  # sequence numbers remembered above the base
+        self.timeout = timeout  # ms before the first retransmission
+        self.retries = retries  # retransmissions before a frame is given up
+        self.epoch = random.getrandbits(30)
+        self.nextseq = {}  # nodeid -> next sequence number
+        self.unacked = {}  # nodeid -> {seq: [frame, due, tries]}
+        self.received = {}  # nodeid -> [epoch, base, [seq, ...]]
+        self.owed = {}  # nodeid -> True, peers owed an ack
+        self.held = {}  # nodeid -> packets waiting for room in the window
+
+        # statistics
+        self.sent = 0
+        self.retransmits = 0
+        self.acked = 0
+        self.failed = 0
+        self.duplicates = 0
+
+    def wants(self, packet):
+        """is the packet to be delivered reliably, multicasts are not"""
+        return packet[1] != 0 and packet[2] in commands
+
+    def inflight(self, nodeid):
+        """the sequence numbers from the oldest unacked frame to the next frame of a peer"""
+        unacked = self.unacked.get(nodeid)
+        if not unacked:
+            return 0
+        return self.nextseq[nodeid] - min(unacked)
+
+    def wrap(self, packet, now=None):
+        """the sequenced frame of a packet, kept for retransmission until it is acked.
+        Returns None if the window of the peer is full, the packet is then held back and sent by due()"""
+        nodeid = packet[1]
+        if self.inflight(nodeid) >= self.window:
+            if (nodeid in self.held) == False:
+                self.held[nodeid] = []
+            self.held[nodeid].append(packet)
+            return None
+
+        seq = self.nextseq.get(nodeid, 1)
+        self.nextseq[nodeid] = seq + 1
+
+        frame = (packet[0], nodeid, 'rel', self.epoch, seq) + tuple(packet[2:])
+        if (nodeid in self.unacked) == False:
+            self.unacked[nodeid] = {}
+        self.unacked[nodeid][seq] = [frame, ticks_add(ticks_ms() if now is None else now, self.timeout), 0]
+        self.sent += 1
+        return frame
+
+    def unwrap(self, frame):
+        """the packet of a received frame, None if it is a duplicate.
+        The frame is recorded and acked by delivered(), once the packet is queued,
+        so a packet that found no room is retransmitted"""
+        fro, epoch, seq = frame[0], frame[3], frame[4]
+
+        state = self.received.get(fro)
+        if state is not None and state[0] == epoch and (seq <= state[1] or (seq in state[2]) == True):
+            self.owed[fro] = True  # acknowledge duplicates too, the ack may have been lost
+            self.duplicates += 1
+            return None
+
+        return [frame[0], frame[1]] + [frame[i] for i in range(5, len(frame))]
+
+    def delivered(self, frame):
+        """records a received frame whose packet is queued, and owes its ack"""
+        fro, epoch, seq = frame[0], frame[3], frame[4]
+        self.owed[fro] = True
+
+        state = self.received.get(fro)
+        if state is None or state[0] != epoch:  # new peer or restarted peer, sequences start at 1
+            state = [epoch, 0, []]
+            self.received[fro] = state
+
+        base, above = state[1], state[2]
+        if seq <= base or (seq in above) == True:
+            return  # recorded already
+
+        above.append(seq)
+        if seq > base + self.window:  # far ahead, forget the oldest gaps
+            base = seq - self.window
+            above = [s for s in above if s > base]
+        while (base + 1 in above) == True:  # advance over the contiguous sequence numbers
+            base += 1
+            above.remove(base)
+        state[1], state[2] = base, above
+
+    def acks(self, nodeid):
+        """the ack packets owed to peers"""
+        packets = []
+        for fro in self.owed:
+            epoch, base, above = self.received[fro]
+            packets.append((nodeid, fro, 'ack', epoch, base, sorted(above)))
+        self.owed = {}
+        return packets
+
+    def onack(self, fro, epoch, base, seqs):
+        """releases the acknowledged frames"""
+        if epoch != self.epoch or (fro in self.unacked) == False:
+            return  # an ack of an earlier boot
+        unacked = self.unacked[fro]
+        for seq in list(unacked):
+            if seq <= base or (seq in seqs) == True:
+                del unacked[seq]
+                self.acked += 1
+        if len(unacked) == 0:
+            del self.unacked[fro]
+
+    def due(self, now=None):
+        """the frames to retransmit, each retry waits twice as long"""
+        now = ticks_ms() if now is None else now
+        frames = []
+        for nodeid in list(self.unacked):
+            unacked = self.unacked[nodeid]
+            for seq in list(unacked):
+                entry = unacked[seq]
+                if ticks_diff(now, entry[1]) < 0:
+                    continue
+                if entry[2] >= self.retries:  # give up
+                    del unacked[seq]
+                    self.failed += 1
+                    continue
+                entry[2] += 1
+                entry[1] = ticks_add(now, self.timeout << entry[2])
+                frames.append(entry[0])
+                self.retransmits += 1
+            if len(unacked) == 0:
+                del self.unacked[nodeid]
+
+        for nodeid in list(self.held):  # send the held packets that fit the window now
+            held = self.held[nodeid]
+            while len(held) and self.inflight(nodeid) < self.window:
+                frames.append(self.wrap(held.pop(0), now))
+            if len(held) == 0:
+                del self.held[nodeid]
+        return frames
+
+    def nextdue(self, now=None):
+        """ms until the next retransmission, 0 if acks or held packets are due, None if nothing is pending"""
+        if len(self.owed):
+            return 0
+        for nodeid in self.held:
+            if self.inflight(nodeid) < self.window:
+                return 0
+        now = ticks_ms() if now is None else now
+        due = None
+        for unacked in self.unacked.values():
+            for entry in unacked.values():
+                wait = max(0, ticks_diff(entry[1], now))
+                if due is None or wait < due:
+                    due = wait
+        return due
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'retransmits': self.retransmits,
+            'acked': self.acked,
+            'failed': self.failed,
+            'duplicates': self.duplicates,
+            'unacked': sum(len(u) for u in self.unacked.values()),
+            'held': sum(len(h) for h in self.held.values())
+        }
+
+
+channel = ReliableChannel()  # reliable delivery of the commands above, for this node
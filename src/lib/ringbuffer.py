@@ -0,0 +1,101 @@
+class RingBuffer():
+    '''
+    Fixed capacity FIFO queue with O(1) append and popleft.
+    When full, the overflow policy decides what is lost:
+        'dropoldest'  the oldest item is dropped
+        'dropnewest'  the appended item is dropped
+        'coalesce'    the appended item replaces the newest queued item with
+                      the same key(item) and moves to the back of the queue,
+                      else the oldest item is dropped
+    Items for which pinned(item) is True are never dropped to make room,
+    the oldest unpinned item is dropped instead, if all are pinned the appended item is dropped
+    '''
+
+    def __init__(self, capacity=64, policy='dropoldest', key=None, pinned=None):
+        if (policy in ('dropoldest', 'dropnewest', 'coalesce')) == False:
+            raise ValueError("unknown overflow policy: {}".format(policy))
+        self.items = [None] * capacity
+        self.capacity = capacity
+        self.policy = policy
+        self.key = key  # key(item) for coalescing, None if not coalescable
+        self.pinned = pinned  # pinned(item) is True if the item must not be dropped, e.g. it was acked
+        self.head = 0  # position of the oldest item
+        self.count = 0
+
+        # statistics
+        self.drops = 0
+        self.coalesced = 0
+        self.highwater = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """iterates oldest to newest"""
+        for i in range(self.count):
+            yield self.items[(self.head + i) % self.capacity]
+
+    def append(self, item):
+        """queues an item, returns False if it was dropped"""
+        if self.count == self.capacity:
+
+            if self.policy == 'coalesce' and self.key is not None:
+                k = self.key(item)
+                if k is not None:
+                    for i in range(self.count - 1, -1, -1):  # newest first
+                        p = (self.head + i) % self.capacity
+                        if self.key(self.items[p]) == k:
+                            # last value wins, and goes last, so no item queued after the
+                            # replaced one, e.g. a grouped update, can overtake it
+                            for j in range(i, self.count - 1):
+                                self.items[(self.head + j) % self.capacity] = self.items[(self.head + j + 1) % self.capacity]
+                            self.items[(self.head + self.count - 1) % self.capacity] = item
+                            self.coalesced += 1
+                            return True
+
+            self.drops += 1
+            if self.policy == 'dropnewest':
+                return False
+            if not self.dropunpinned():
+                return False  # all pinned, the appended item is dropped
+
+        self.items[(self.head + self.count) % self.capacity] = item
+        self.count += 1
+        if self.count > self.highwater:
+            self.highwater = self.count
+        return True
+
+    def dropunpinned(self):
+        """drops the oldest item that is not pinned, returns False if all are pinned"""
+        for i in range(self.count):  # oldest first
+            if self.pinned is None or not self.pinned(self.items[(self.head + i) % self.capacity]):
+                for j in range(i, 0, -1):  # the older items move up over it
+                    self.items[(self.head + j) % self.capacity] = self.items[(self.head + j - 1) % self.capacity]
+                self.popleft()
+                return True
+        return False
+
+    def popleft(self):
+        """removes and returns the oldest item"""
+        if self.count == 0:
+            raise IndexError("pop from an empty RingBuffer")
+        item = self.items[self.head]
+        self.items[self.head] = None  # release the reference
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        return item
+
+    def clear(self):
+        for i in range(self.count):
+            self.items[(self.head + i) % self.capacity] = None
+        self.head = 0
+        self.count = 0
+
+    def stats(self):
+        return {
+            'length': self.count,
+            'capacity': self.capacity,
+            'highwater': self.highwater,
+            'drops': self.drops,
+            'coalesced': self.coalesced
+        }
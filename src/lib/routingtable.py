@@ -0,0 +1,144 @@
+from lib.clock import ticks_ms, ticks_diff
+
+# positions in a route entry
+ADDRESS = 0
+LASTSEEN = 1
+RX = 2
+TX = 3
+RTT = 4
+PROBE = 5
+
+
+class RoutingTable():
+    '''
+    Bounded table of peer addresses, learned from received packets.
+    A route expires after ttl ms without traffic, when full the least
+    recently seen route is evicted. Keeps the last seen time, packet
+    counters and the round trip time per peer. Packets for unknown
+    peers are parked for parktime ms while the peer is discovered.
+    '''
+
+    def __init__(self, size=32, ttl=300000, parktime=2000, parksize=8):
+        self.size = size  # maximum number of routes
+        self.ttl = ttl  # ms a route lives without traffic
+        self.parktime = parktime  # ms a packet waits for discovery
+        self.parksize = parksize  # maximum packets parked per peer
+        self.routes = {}  # nodeid -> [address, lastseen, rx, tx, rtt, probe]
+        self.parked = {}  # nodeid -> (since, [packets])
+
+        # statistics
+        self.evicted = 0
+        self.expired = 0
+        self.dropped = 0  # parked packets that were never delivered
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, nodeid):
+        return nodeid in self.routes
+
+    def seen(self, nodeid, address, now=None):
+        """registers traffic from a peer, returns the packets parked for it"""
+        now = ticks_ms() if now is None else now
+
+        if (nodeid in self.routes) == False:
+            if len(self.routes) >= self.size:
+                self.evict()
+            self.routes[nodeid] = [address, now, 0, 0, None, None]
+
+        route = self.routes[nodeid]
+        route[ADDRESS] = address
+        route[LASTSEEN] = now
+        route[RX] += 1
+        if route[PROBE] is not None:  # answer to a probe
+            route[RTT] = ticks_diff(now, route[PROBE])
+            route[PROBE] = None
+
+        if (nodeid in self.parked) == True:  # discovered
+            since, packets = self.parked[nodeid]
+            del self.parked[nodeid]
+            if route[RTT] is None:
+                route[RTT] = ticks_diff(now, since)
+            return packets
+        return ()
+
+    def lookup(self, nodeid, now=None):
+        """the address of a peer, None if unknown or expired"""
+        if (nodeid in self.routes) == False:
+            return None
+        route = self.routes[nodeid]
+        if ticks_diff(ticks_ms() if now is None else now, route[LASTSEEN]) > self.ttl:
+            del self.routes[nodeid]
+            self.expired += 1
+            return None
+        route[TX] += 1
+        return route[ADDRESS]
+
+    def probe(self, nodeid, now=None):
+        """marks a request to a peer, its next packet measures the round trip time"""
+        if (nodeid in self.routes) == True and self.routes[nodeid][PROBE] is None:
+            self.routes[nodeid][PROBE] = ticks_ms() if now is None else now
+
+    def park(self, nodeid, packet, now=None):
+        """holds a packet for an unknown peer, returns True for the first one, when to discover the peer"""
+        if (nodeid in self.parked) == False:
+            if len(self.parked) >= self.size:
+                self.dropped += 1
+                return False
+            self.parked[nodeid] = (ticks_ms() if now is None else now, [packet])
+            return True
+
+        packets = self.parked[nodeid][1]
+        if len(packets) >= self.parksize:
+            packets.pop(0)
+            self.dropped += 1
+        packets.append(packet)
+        return False
+
+    def expire(self, now=None):
+        """drops parked packets whose peer was not discovered in time, and stale routes"""
+        now = ticks_ms() if now is None else now
+
+        for nodeid in list(self.parked):
+            since, packets = self.parked[nodeid]
+            if ticks_diff(now, since) > self.parktime:
+                self.dropped += len(packets)
+                del self.parked[nodeid]
+
+        for nodeid in list(self.routes):
+            if ticks_diff(now, self.routes[nodeid][LASTSEEN]) > self.ttl:
+                del self.routes[nodeid]
+                self.expired += 1
+
+    def evict(self):
+        """removes the least recently seen route"""
+        oldest = None
+        for nodeid in self.routes:
+            if oldest is None or ticks_diff(self.routes[oldest][LASTSEEN], self.routes[nodeid][LASTSEEN]) > 0:
+                oldest = nodeid
+        del self.routes[oldest]
+        self.evicted += 1
+
+    def stats(self, now=None):
+        """the routing table as a dictionary, for inspection"""
+        now = ticks_ms() if now is None else now
+        routes = {}
+        for nodeid, route in self.routes.items():
+            routes[nodeid] = {
+                'address': '{}:{}'.format(route[ADDRESS][0], route[ADDRESS][1]),
+                'age': ticks_diff(now, route[LASTSEEN]),
+                'rx': route[RX],
+                'tx': route[TX],
+                'rtt': -1 if route[RTT] is None else route[RTT]
+            }
+        return {
+            'routes': routes,
+            'size': self.size,
+            'parked': sum(len(p[1]) for p in self.parked.values()),
+            'evicted': self.evicted,
+            'expired': self.expired,
+            'dropped': self.dropped
+        }
+
+
+rt = RoutingTable()  # the routing table of this node
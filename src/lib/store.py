@@ -1,4 +1,8 @@
 from config import nodekey
+try:
+  import urandom as random
+except ImportError:
+  import random
 
 class Store():
 
@@ -16,6 +20,15 @@ class Store():
     self.shadowlisteners = {}
     self.discovered = {}
     self.shadows = {}
+    self.routes = {} # nodeid -> routing table of the node
+    self.wireindex = {} # (modelid,prop) -> ((nodeid,((modelid,prop),...)),...) wire listeners grouped by node
+    self.savedwires = {} # modelid -> wires, restored when the model is added
+    self.epoch = random.getrandbits(30) # model versions restart on boot, shadows of another epoch are resent whole
+    self.shadowepochs = {} # nodeid -> epoch of the shadow
+    self.resyncs = {} # nodeid -> ticks of the last resync request
+    self.shadowsent = {} # (listenernodeid, modelid, prop) -> version of the last shadow update sent
+    self.shadowversions = {} # (nodeid, modelid) -> {prop: version} of the shadow updates since a snapshot or patch
+    self.revision = 0 # counts the changes of the store, invalidates cached encodings
 
   #EVENT
   #on - adds an event callback
@@ -29,6 +42,7 @@ class Store():
   # @param n String event name
   # @param ... Arguments passed to the event callback
   def emit(self,name,*args):
+    self.changed() # every store event is a change of the store
     if (name in self.ev) == True:
       for callback in self.ev[name]:
         callback(*args)
@@ -37,8 +51,54 @@ class Store():
         callback(*args)
   
   
-  def serialize(self):
-      pass
+  #changed - counts a change of the store, cached encodings are rebuilt on the next use
+  def changed(self):
+    self.revision += 1
+
+  def serialize(self, filename='store.json'):
+      """write the wires of the models to flash, so they survive a restart"""
+      import json
+      wires = {}
+      for modelid in self.models:
+        wires[modelid] = self.models[modelid].wires
+      try:
+        with open(filename, 'w') as file:
+          json.dump({'wires':wires}, file)
+      except OSError:
+        pass
+
+  def deserialize(self, filename='store.json'):
+      """load the saved wires from flash, they are restored as models are added"""
+      import json
+      try:
+        with open(filename, 'r') as file:
+          self.savedwires = json.load(file)['wires']
+      except Exception:
+        self.savedwires = {}
+
+  #WIRE INDEX
+  #indexwires - parses the wire listeners of a model prop once, grouped by destination node
+  # @param model Model the producer model
+  # @param prop String the producer prop, all props when None
+  def indexwires(self, model, prop=None):
+      props = list(model.wires) if prop is None else [prop]
+      for prop in props:
+        bynode = {}
+        for listeneruri in model.wires.get(prop, {}):
+          nodeid, modelid, listenerprop = tuple(listeneruri.split('/'))
+          if (nodeid in bynode) == False: bynode[nodeid] = []
+          bynode[nodeid].append((modelid, listenerprop))
+
+        if len(bynode):
+          self.wireindex[(model.id, prop)] = tuple((nodeid, tuple(bynode[nodeid])) for nodeid in bynode)
+        elif ((model.id, prop) in self.wireindex) == True:
+          del self.wireindex[(model.id, prop)]
+
+  #unindexwires - removes all wire listeners of a model from the index
+  # @param modelid String
+  def unindexwires(self, modelid):
+      for key in [key for key in self.wireindex if key[0] == modelid]:
+        del self.wireindex[key]
 
   # TODO currenlty only used by wstrasnport ... reduce memeory footprint
   def toDict(self):
@@ -1,15 +1,43 @@
 import socket
-from lib.bencode import bencode, bdecode
-from lib.reactor import receive, sendqueue
+from lib.bencode import BencodeFailure, BencodeWriter, LazyList, bdecodeview
+from config import nodekey
+from lib import reactor
+from lib.reactor import accepts, coalescer, flush, receive, sendqueue
+from lib.reliable import channel
+from lib.routingtable import rt
+from lib.fragment import fragments, reassembler
+from lib.wireformat import compact, compactable, expand, opcodes
 
 try: # try to make this work for both python37 and micropython
     import ustruct as struct            
 except ImportError:
     import struct
 
-rt = {} # routing table
+try:
+    import uselect as select
+except ImportError:
+    import select
+
+try:
+    import uasyncio as asyncio
+    from uasyncio import core
+except ImportError:
+    import asyncio
+    core = None
+
+writer = BencodeWriter(2048) # reusable send buffer
+rxbuffer = bytearray(2048) # reusable receive buffer
+rxview = memoryview(rxbuffer)
+rxstats = {'datagrams':0, 'packets':0, 'bytes':0, 'dropped':0} # received by the last receiveudp call, dropped malformed
+txstats = {'failed':0} # datagrams the socket refused, e.g. wifi down or out of memory
+pollers = {} # socket -> poll object
+sendevent = asyncio.Event() # set when packets are queued to be sent
 port = 3300 # TODO find the port thans is least blocked by NAT's
 multiaddr = '225.0.0.37'  # TOSO find a free but mostly acceptable address
+mtu = 1400 # maximum datagram payload, packets to the same address are batched up to it
+ENVELOPE = ord('l') # a datagram starting with a list of lists is an envelope of packets
+FRAGMENTHEADER = 96 # bytes reserved for the header of a fragment
+msgid = 0 # id of the last fragmented message
 
 def aton(ipv4address):
     """convert an IPv4 address to 32-bit packed binary format"""
@@ -33,41 +61,269 @@ def getsocket(ip):
     #sock.settimeout(0.0001)
     return sock
 
-def receiveudp (sock):
-    """ receives datagram messages and queues them for processing, updates a routing table """
+def readable (sock):
+    """ is a datagram waiting, polls without raising on an empty socket """
+    if (sock in pollers) == False:
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        pollers[sock] = poller
+    return len(pollers[sock].poll(0)) > 0
+
+def recvdatagram (sock):
+    """ receives a datagram into the reusable receive buffer, returns (data, address) """
+    if hasattr(sock, 'recvfrom_into'):
+        n, address = sock.recvfrom_into(rxbuffer)
+        return (rxview[:n], address)
+    return sock.recvfrom(len(rxbuffer)) # micropython has no recvfrom_into
+
+def receiveudp (sock, maxdatagrams=16):
+    """ receives the waiting datagrams, up to a budget, and queues their packets for processing,
+    updates a routing table, returns the number of packets and bytes received """
+    datagrams, packets, nbytes, dropped = 0, 0, 0, 0
+    reassembler.expire()
+
+    while datagrams < maxdatagrams and readable(sock):
+        try:
+            bytedata, address = recvdatagram(sock)
+        except OSError:
+            break # nothing available after all
+        datagrams += 1
+        nbytes += len(bytedata)
+
+        # decode lazily, only the routing fields are materialised
+        try:
+            datagram = bdecodeview(bytedata)
+        except BencodeFailure: # trailing data, a malformed datagram must not stop the receiver
+            dropped += 1
+            continue
+
+        if type(datagram) != LazyList:
+            dropped += 1
+            continue
+
+        if len(bytedata) > 1 and bytedata[1] == ENVELOPE: # a list of packets
+            for i in range(len(datagram)):
+                if receivesafely(datagram.lazy(i), address):
+                    packets += 1
+                else:
+                    dropped += 1
+        elif receivesafely(datagram, address):
+            packets += 1
+        else:
+            dropped += 1
+
+    rxstats['datagrams'] = datagrams
+    rxstats['packets'] = packets
+    rxstats['bytes'] = nbytes
+    rxstats['dropped'] = dropped
+    return (packets, nbytes)
+
+def receivesafely (packet, address):
+    """ receives a packet, returns False if it is malformed, e.g. too short or of the wrong types """
     try:
-        bytedata, address = sock.recvfrom(2048) # Buffer size is 2048. Change as needed.
-    except Exception:
-        pass
-        # exceptions will be continoulsy thrown due to the non-blocking of recivefrom
-    else:
-        if bytedata:
+        receivepacket(packet, address)
+    except (BencodeFailure, IndexError, TypeError, ValueError):
+        return False
+    return True
+
+def receivepacket (packet, address):
+    """ queues a packet for processing, updates the routing table """
+    if type(packet) != LazyList: return
+
+    packet = expand(packet) # compact packets of negotiated peers
+    if packet == False: # from a peer that negotiated with a previous boot, e.g. after a reboot
+        reactor.renegotiate()
+        return
+    #print('receiveudp', packet)
+    
+    fro = packet[0]
+    if fro:
+        parked = rt.seen(fro, (address[0],address[1]))  # update the routing table
+        if len(parked): # the peer is discovered, send the packets that waited for it
+            for waiting in parked:
+                sendqueue.append(waiting)
+            reactor.onsend()
+
+    command = packet[2]
+    if command == 'frag': # a fragment of a message larger than a datagram
+        if packet[1] != nodekey and packet[1] != 0: return # not for me
+        data = reassembler.add(fro, packet[3], packet[4], packet[5], packet[6])
+        if data is not None:
+            receivepacket(bdecodeview(data), address)
+        return
+
+    frame = None
+    if command == 'rel' or command == 'ack': # the reliable delivery layer
+        if packet[1] != nodekey: return # not for me
+        if command == 'ack':
+            return channel.onack(packet[0], packet[3], packet[4], packet[5])
+        frame, packet = packet, channel.unwrap(packet)
+        if packet is None: # a duplicate, its ack is owed again
+            reactor.onsend()
+            return
+
+    if not accepts(packet): # drop before decoding the payload
+        if frame is not None:
+            deliveredframe(frame)
+        return
 
-            print('receiveudp', bytedata, len(bytedata))
-            packet = bdecode(bytedata)
+    if type(packet) == LazyList: # detach from the reusable receive buffer
+        packet = packet.materialize()
+    if receive(packet) != False and frame is not None: # acked once queued, else it is retransmitted
+        deliveredframe(frame)
 
-            if packet == False: return 
-            #print('receiveudp', packet)
-            
-            fro = packet[0]
-            if fro:
-                rt[fro] = (address[0],address[1])  # update the routing table
+def deliveredframe (frame):
+    """ records a reliable frame as delivered, an ack is owed """
+    channel.delivered(frame)
+    reactor.onsend()
 
-            receive(packet)
+def route (packet):
+    """ the address of the destination of a packet, None if the destination is unknown """
+    nodeid = packet[1]
+    if nodeid == 0 : #  multicast
+        return (multiaddr,port)
+
+    address = rt.lookup(nodeid)
+    if address is not None and packet[2] == 'announce':
+        rt.probe(nodeid) # the answer measures the round trip time
+    return address
 
 def sendudp (sock):
-    """ """
+    """ sends the queued packets and the coalesced packets that are due,
+    packets to the same address are batched into datagrams of up to mtu bytes """
+    flush()
+    rt.expire()
+    batches = {} # address -> packets
     for packet in sendqueue:
 
-            nodeid = packet[1]
-            bytedata = bencode(packet)
-            print('sendudp', bytedata, len(bytedata))
-            
-            if nodeid == 0 : #  multicast
-                sock.sendto(bytedata, (multiaddr,port))
-            elif (nodeid in rt)==True : #  unicast 
-                sock.sendto(bytedata, rt[nodeid])
-            else:
-                print('destination unknown for', nodeid)
-                sock.sendto(bytedata, (multiaddr,port))
+            address = route(packet)
+            if address is None: # unknown destination, park the packet until it is discovered
+                if not rt.park(packet[1], packet):
+                    continue
+                # multicast a targeted announce request instead, only the destination answers
+                packet = (nodekey, packet[1], 'announce')
+                address = (multiaddr,port)
+            elif channel.wants(packet): # sequenced, kept until acked
+                packet = channel.wrap(packet)
+                if packet is None:
+                    continue # held back until the window has room
+            addtobatch(batches, address, packet)
     sendqueue.clear()
+
+    # retransmissions and acks of the reliable delivery layer
+    for packet in channel.due() + channel.acks(nodekey):
+        address = route(packet)
+        if address is not None:
+            addtobatch(batches, address, packet)
+
+    for address in batches:
+        sendbatch(sock, batches[address], address)
+
+def addtobatch (batches, address, packet):
+    """ adds a packet to the batch of an address """
+    if compactable(packet): # negotiated the compact encoding
+        packet = compact(packet)
+    if (address in batches) == False:
+        batches[address] = []
+    batches[address].append(packet)
+
+def sendbatch (sock, packets, address):
+    """ sends packets as envelopes, bencoded lists of packets that fit the mtu """
+    writer.pos = 0
+    writer.putbyte(ENVELOPE)
+    count, previous = 0, None
+    for packet in packets:
+        mark = writer.pos
+        writer.write(packet)
+        if writer.pos + 1 > mtu and count > 0: # does not fit, send the envelope without it
+            writer.pos = mark
+            sendenvelope(sock, count, address, previous)
+            writer.pos = 0
+            writer.putbyte(ENVELOPE)
+            writer.write(packet)
+            count = 0
+        count += 1
+        previous = packet
+    sendenvelope(sock, count, address, previous)
+
+def sendenvelope (sock, count, address, packet):
+    """ sends the envelope in the writer, a single packet is sent without envelope,
+    a single packet larger than the mtu is sent in fragments """
+    if count == 1:
+        if writer.pos - 1 > mtu:
+            sendfragments(sock, bytes(writer.view()[1:]), address, packet)
+        else:
+            senddatagram(sock, writer.view()[1:], address)
+    else:
+        writer.putbyte(ord('e'))
+        senddatagram(sock, writer.view(), address)
+
+def senddatagram (sock, data, address):
+    """ sends a datagram, returns False if the socket refused it, e.g. ENOMEM or EHOSTUNREACH on the esp32.
+    The datagram is lost, reliable frames are kept until acked so they are retransmitted """
+    try:
+        sock.sendto(data, address)
+    except OSError:
+        txstats['failed'] += 1
+        return False
+    return True
+
+def sendfragments (sock, data, address, packet):
+    """ sends bencoded bytes as (fro, to, 'frag', msgid, index, count, chunk) packets """
+    global msgid
+    msgid = (msgid + 1) & 0xFFFF
+    # fragments of a compact packet are compact too
+    command = opcodes['frag'] if type(packet[2]) == int else 'frag'
+    chunks = list(fragments(data, mtu - FRAGMENTHEADER))
+    for index in range(len(chunks)):
+        writer.encode((packet[0], packet[1], command, msgid, index, len(chunks), chunks[index]))
+        if not senddatagram(sock, writer.view(), address):
+            return # the message is lost without any one fragment
+
+def waitreadable (sock):
+    """ awaitable, parks the task on the uasyncio io queue until the socket is readable """
+    yield core._io_queue.queue_read(sock)
+
+if core is None: # python37, wait on the selector of the event loop instead
+    async def waitreadable (sock):
+        """ awaitable, waits until the socket is readable """
+        loop = asyncio.get_event_loop()
+        ready = asyncio.Event()
+        loop.add_reader(sock, ready.set)
+        try:
+            await ready.wait()
+        finally:
+            loop.remove_reader(sock)
+
+async def waitfor (awaitable, ms):
+    """ awaits with a timeout in ms, returns False on timeout """
+    try:
+        if hasattr(asyncio, 'wait_for_ms'):
+            await asyncio.wait_for_ms(awaitable, ms)
+        else:
+            await asyncio.wait_for(awaitable, ms / 1000)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+async def receivetask (sock):
+    """ receives datagrams only when the socket is readable, the reactor wakes the react task """
+    while 1:
+        await waitreadable(sock)
+        receiveudp(sock)
+        await asyncio.sleep(0) # leave the rest to the next turn when the budget was spent
+
+async def sendtask (sock):
+    """ sends only when packets are queued, or when coalesced packets, retransmissions or acks are due """
+    while 1:
+        if len(sendqueue) == 0:
+            due = coalescer.nextdue()
+            retransmit = channel.nextdue()
+            if due is None or (retransmit is not None and retransmit < due):
+                due = retransmit
+            if due is None:
+                await sendevent.wait()
+            else:
+                await waitfor(sendevent.wait(), due)
+        sendevent.clear()
+        sendudp(sock)
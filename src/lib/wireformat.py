@@ -0,0 +1,148 @@
+"""
+Compact wire encoding, negotiated per peer.
+Command names and common dictionary keys are replaced by small opcodes
+from shared tables, node ids by short fixed width integer ids.
+A compact packet is still plain bencode, so bdecode decodes it.
+"""
+from config import nodekey
+
+enabled = True  # offer the compact encoding to peers
+version = 2  # version of the shared tables
+
+# shared tables, only ever append, the position is the opcode
+commands = (
+    'announce',
+    'updatemodel',
+    'addwirelistener',
+    'removewirelistener',
+    'addshadowlistener',
+    'removeshadowlistener',
+    'addbrick',
+    'removemodel',
+    'adddescription',
+    'addshadow',
+    'removeshadow',
+    'shadowaddmodel',
+    'shadowremovemodel',
+    'updateshadowmodel',
+    'shadowaddwirelistener',
+    'shadowremovewirelistener',
+    'negotiate',
+    'updatemodels',
+    'routes',
+    'addroutes',
+    'rel',
+    'ack',
+    'frag',
+    'resyncshadow',
+    'patchshadow'
+)
+
+keys = (
+    'clazz',
+    'type',
+    'id',
+    'nodeid',
+    'wires',
+    'meta',
+    'props',
+    'index',
+    'display',
+    'group',
+    'label',
+    'options',
+    'version'
+)
+
+opcodes = {}  # command -> opcode
+for opcode, command in enumerate(commands):
+    opcodes[command] = opcode
+
+# an interned key is a single control character, chr(1) is keys[0]
+keycodes = {}  # key -> interned key
+for i, key in enumerate(keys):
+    keycodes[key] = chr(i + 1)
+
+peers = {}  # nodeid -> version, of peers that accept the compact encoding
+nodes = {}  # shortid -> nodeid, of negotiated peers
+
+
+def shortid(nodeid):
+    """a 7 digit integer id of a nodeid, 0 (multicast) stays 0"""
+    if not nodeid:
+        return 0
+    h = 2166136261  # 32 bit FNV-1a
+    for c in bytes(nodeid, 'utf-8'):
+        h = ((h ^ c) * 16777619) & 0xFFFFFFFF
+    return 1000000 + h % 9000000
+
+
+nodes[shortid(nodekey)] = nodekey
+
+
+def acceptpeer(nodeid, peerversion):
+    """registers a peer that speaks our version of the compact encoding"""
+    if not enabled or peerversion != version:
+        return False
+    peers[nodeid] = peerversion
+    nodes[shortid(nodeid)] = nodeid
+    return True
+
+
+def compactable(packet):
+    """is the packet for a negotiated peer, negotiation itself stays readable"""
+    return (packet[1] in peers) == True and packet[2] != 'negotiate'
+
+
+def compactvalue(x):
+    """interns the common dictionary keys of a value"""
+    if type(x) == dict:
+        r = {}
+        for k, v in x.items():
+            r[keycodes.get(k, k)] = compactvalue(v)
+        return r
+    if type(x) == list or type(x) == tuple:
+        return [compactvalue(v) for v in x]
+    return x
+
+
+def expandvalue(x):
+    """restores the interned dictionary keys of a value"""
+    if type(x) == dict:
+        r = {}
+        for k, v in x.items():
+            if len(k) == 1 and 0 < ord(k) <= len(keys):
+                k = keys[ord(k) - 1]
+            r[k] = expandvalue(v)
+        return r
+    if type(x) == list:
+        return [expandvalue(v) for v in x]
+    return x
+
+
+def compact(packet):
+    """converts a packet to the compact encoding"""
+    command = packet[2]
+    packed = [shortid(packet[0]), shortid(packet[1]), opcodes.get(command, command)]
+    for i in range(3, len(packet)):
+        packed.append(compactvalue(packet[i]))
+    return packed
+
+
+def expand(packet):
+    """converts a compact packet back, other packets are returned unchanged
+    returns False if the packet is from or to an unknown short id"""
+    command = packet[2]
+    if type(command) != int:
+        return packet  # not compact
+
+    fro, to = packet[0], packet[1]
+    if (fro in nodes) == False or (to != 0 and (to in nodes) == False):
+        return False  # not negotiated
+
+    expanded = [nodes[fro], nodes[to] if to else 0,
+                commands[command] if command < len(commands) else command]
+    for i, v in enumerate(packet):
+        if i > 2:
+            expanded.append(expandvalue(v))
+    return expanded
@@ -2,9 +2,29 @@ from config import ip
 from SimpleWebSocketServer import SimpleWebSocketServer, WebSocket
 from lib.actor import doaction
 from lib.bencode import bencode, bdecode
+from lib.clock import ticks_ms, ticks_diff
 from lib.store import Store
 
 store = Store()
+message = [None, -1] # the bencoded update message and the store revision it was encoded at
+interval = 100 # ms, bursts of store events are pushed to the clients at most once per interval
+pending = {} # (nodeid, modelid, prop) -> value, the shadow prop changes since the last push
+pushed = [0, False] # ticks of the last push, and whether the whole state must be pushed
+maxbytes = 65536 # per client, bytes queued before the policy applies
+policy = 'collapse' # on a full queue: 'collapse' to the latest snapshot, 'dropdeltas', or 'disconnect'
+
+# store events that change the structure of the state, the clients then get the whole state
+structural = (
+    'adddescription',
+    'addroutes',
+    'addshadow',
+    'patchshadow',
+    'removeshadow',
+    'shadowaddmodel',
+    'shadowremovemodel',
+    'shadowaddwire',
+    'shadowremovewire'
+)
 
 def storeData():
     return {
@@ -12,24 +32,145 @@ def storeData():
         'shadows':store.shadows
     }
 
-def updateAllClients(websocketserver,store):
+def updateMessage():
+    """the bencoded update message, encoded once per store revision"""
+    if message[1] != store.revision:
+        message[0] = bencode(['update',storeData()])
+        message[1] = store.revision
+    return message[0]
+
+def patchMessage():
+    """the bencoded shadow prop changes since the last push, as [nodeid, modelid, prop, value] deltas"""
+    deltas = [[key[0], key[1], key[2], pending[key]] for key in pending]
+    return bencode(['patch',deltas])
+
+def changed(prop, value, shadowmodel):
+    """a shadow prop changed, only the latest value per prop is pushed"""
+    pending[(shadowmodel['nodeid'], shadowmodel['id'], prop)] = value
+
+def restructured(*args):
+    """the structure of the state changed, the whole state is pushed"""
+    pushed[1] = True
+
+def updateAllClients(websocketserver, force=False):
+    """queues the changes since the last push to all clients, at most once per interval, encoded once,
+    and hands each client its next message once the previous one is sent"""
+    now = ticks_ms()
+    msg, snapshot = None, False
+    if (pushed[1] or len(pending)) and (force or ticks_diff(now, pushed[0]) >= interval):
+        snapshot = pushed[1]
+        msg = updateMessage() if snapshot else patchMessage()
+        pending.clear()
+        pushed[0] = now
+        pushed[1] = False
+
+    # print(len(msg))
+    for fileno in list(websocketserver.connections):
+        connection = websocketserver.connections[fileno]
+        if hasattr(connection, 'outq') == False:
+            continue # still handshaking
+        if msg is not None:
+            connection.queue(msg, snapshot, now)
+        connection.pump(now)
+
+def clientstats(websocketserver):
+    """the queue and lag statistics of each client, by address, a client asks with a ['clients'] message"""
+    stats = {}
     for fileno in websocketserver.connections:
         connection = websocketserver.connections[fileno]
-        msg = bencode(['update',storeData()])
-        # print(len(msg))
-        connection.sendMessage(msg)
+        if hasattr(connection, 'outq') == False:
+            continue # still handshaking
+        stats['{}:{}'.format(connection.address[0], connection.address[1])] = connection.stats()
+    return stats
 
 class WssHandler(WebSocket):
+    '''
+    A dashboard client. Messages wait in an outbound queue, and are
+    handed to the socket one at a time, once the previous one is sent.
+    A stalled client fills its queue up to maxbytes, then the policy applies
+    '''
+
+    def reset(self):
+        self.outq = [] # [msg, ticks queued]
+        self.outbytes = 0
+        self.stale = False # deltas were dropped, a snapshot is due
+        self.closing = False
+        # statistics
+        self.sent = 0
+        self.dropped = 0
+        self.collapsed = 0
+
+    def queue(self, msg, snapshot=False, now=None):
+        """queues a message, applies the policy when the queue is full"""
+        now = ticks_ms() if now is None else now
+        if self.closing:
+            return
+        if snapshot:
+            self.stale = False
+        elif self.stale:
+            self.dropped += 1
+            return # a snapshot is due, it includes this delta
+
+        if self.outbytes + len(msg) > maxbytes:
+            if policy == 'disconnect':
+                print(self.address, 'too slow, disconnecting')
+                self.closing = True
+                self.close()
+                return
+            if policy == 'dropdeltas' and not snapshot:
+                self.dropped += 1
+                self.stale = True # the snapshot is queued once the queue drains
+                return
+            # collapse, the queued messages are superseded by the latest snapshot
+            self.dropped += len(self.outq)
+            self.collapsed += 1
+            self.outq = []
+            self.outbytes = 0
+            self.stale = False
+            msg = updateMessage()
+
+        self.outq.append([msg, now])
+        self.outbytes += len(msg)
+
+    def pump(self, now=None):
+        """hands the next queued message to the socket, once the previous one is sent"""
+        if len(getattr(self, 'sendq', ())):
+            return # the socket is still sending
+        if not len(self.outq) and self.stale and not self.closing:
+            self.queue(updateMessage(), True, now)
+        if not len(self.outq):
+            return
+        msg = self.outq.pop(0)[0]
+        self.outbytes -= len(msg)
+        self.sent += 1
+        self.sendMessage(msg)
+
+    def stats(self, now=None):
+        """lag is the age of the oldest queued message in ms"""
+        now = ticks_ms() if now is None else now
+        return {
+            'queued': len(self.outq),
+            'bytes': self.outbytes,
+            'lag': ticks_diff(now, self.outq[0][1]) if len(self.outq) else 0,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'collapsed': self.collapsed
+        }
 
     def handleMessage(self):
         action = bdecode( self.data )
         print(self.data)
+        if action and action[0] == 'clients': # answered here, the statistics are of this server
+            self.queue(bencode(['clients',clientstats(self.server)]))
+            self.pump()
+            return
         doaction(action)
 
     def handleConnected(self):
         print(self.address, 'connected')
-        msg = bencode(['update',storeData()])
-        self.sendMessage(msg)
+        self.reset()
+        self.queue(updateMessage(), True) # the snapshot, the patches follow
+        self.pump()
 
     def handleClose(self):
         print(self.address, 'closed')
@@ -37,7 +178,9 @@ class WssHandler(WebSocket):
 def getwebsocket():
     print('creating websockes server on',ip,':9090')
     websocketserver = SimpleWebSocketServer(ip, 9090, WssHandler)
-    # register for all store events
-    store.on('*', lambda *args: updateAllClients(websocketserver,store))
+    # register for the store events, pushed by updateAllClients
+    store.on('updateshadowmodel', changed)
+    for name in structural:
+        store.on(name, restructured)
 
     return websocketserver
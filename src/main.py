@@ -3,19 +3,28 @@ import uasyncio as asyncio
 from config import ip
 from lib.wifi import joinwifi
 from lib.product import Product
-from lib.reactor import addmodel, announce, react
-from lib.udptransport import getsocket, receiveudp, sendudp
+from lib import reactor
+from lib.reactor import addmodel, announce, react, receivequeue, store
+from lib.udptransport import getsocket, receivetask, sendevent, sendtask
 
-async def reactTask(sock):
+reactevent = asyncio.Event()
+reactor.onreceive = reactevent.set # wake the reactTask when packets arrive
+reactor.onsend = sendevent.set # wake the sendtask when packets are queued
+
+async def reactTask():
     while 1:
-        receiveudp(sock)
-        react()
-        sendudp(sock)
-        await asyncio.sleep(0)
+        await reactevent.wait()
+        reactevent.clear()
+        react(maxms=20) # yield to the other tasks after 20ms
+        while len(receivequeue):
+            await asyncio.sleep(0)
+            react(maxms=20)
 
 async def websockTask(websock):
+    from lib.wstransport import updateAllClients
     while 1:
         websock.serveonce()
+        updateAllClients(websock) # debounced, pushes the store changes at most once per interval
         await asyncio.sleep(0)
 
 async def heartbeatTask():
@@ -26,7 +35,9 @@ async def heartbeatTask():
 async def main_task():
 
     sock = getsocket(ip)
-    asyncio.create_task( reactTask(sock) )
+    asyncio.create_task( receivetask(sock) )
+    asyncio.create_task( reactTask() )
+    asyncio.create_task( sendtask(sock) )
     asyncio.create_task( heartbeatTask() )
 
     while 1:
@@ -36,6 +47,7 @@ async def main_task():
 if __name__ == "__main__":
 
         print('WireUp Agent v0.1')
+        store.deserialize() # saved wires are restored as models are added
         product = Product()
         addmodel(product)
         asyncio.run( main_task() )